@@ -0,0 +1,102 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import schema
+from helper import RateLimiter
+
+FEED_URL = "https://api.waqi.info/feed/{place_id}/"
+
+
+class Client:
+    """AQICN API client sharing one pooled keep-alive session between threads
+
+    Requests are sent by a bounded thread pool, rate limited by a token bucket,
+    and retried with backoff on connection errors and 429/5xx responses.
+    """
+
+    def __init__(
+        self,
+        token: str | None = None,
+        max_workers: int = 8,
+        requests_per_second: float = 10.0,
+        timeout: float = 10.0,
+        retries: int = 3,
+    ):
+        self.token = token or os.environ["AQICN_ORG_API_TOKEN"]
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.limiter = RateLimiter(requests_per_second, burst=max_workers)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+            ),
+        )
+        self.session.mount("https://", adapter)
+
+    def feed(self, place_id: str) -> dict:
+        """Get the live feed data of a sensor"""
+        self.limiter.acquire()
+        resp = self.session.get(
+            FEED_URL.format(place_id=place_id),
+            params={"token": self.token},
+            timeout=self.timeout,
+        )
+        resp.raise_for_status()
+        body = resp.json()
+        if body["status"] != "ok":
+            raise ValueError(f"AQICN feed for {place_id} failed: {body['data']}")
+        return body["data"]
+
+    def feeds(self, place_ids: list[str]) -> dict[str, dict]:
+        """Get the live feed data of many sensors concurrently
+
+        Returns:
+            dict of place id to feed data, in the order of `place_ids`"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(place_ids, executor.map(self.feed, place_ids)))
+
+
+def get_current_pm25(
+    places: dict[str, dict], client: Client | None = None
+) -> pd.DataFrame:
+    """Get the latest pm25 reading of all places
+
+    Returns:
+        pd.DataFrame with columns [id, date, pm25], see `schema.coerce`"""
+    client = client or Client()
+    records = [
+        {
+            "id": place_id,
+            "date": pd.to_datetime(data["time"]["iso"]).date(),
+            "pm25": float(data["iaqi"]["pm25"]["v"]),
+        }
+        for place_id, data in client.feeds(list(places.keys())).items()
+    ]
+    aq_df = pd.DataFrame(records, columns=["id", "date", "pm25"])
+    return schema.coerce(aq_df, places)
+
+
+def add_geo(places: dict[str, dict], client: Client | None = None) -> None:
+    """Fill in latitude and longitude of places that are missing them
+
+    The parameter is modified in place."""
+    missing = [
+        place_id for place_id, place in places.items() if "latitude" not in place
+    ]
+    if not missing:
+        return
+    client = client or Client()
+    for place_id, data in client.feeds(missing).items():
+        latitude, longitude = data["city"]["geo"]
+        places[place_id]["latitude"] = latitude
+        places[place_id]["longitude"] = longitude
@@ -0,0 +1,172 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import forecast
+import schema
+from helper import asof_join, process_pool
+
+# Days forecasted from each origin, as far ahead as the daily weather forecast
+HORIZON_DAYS = 9
+
+
+def read_history(
+    air_quality_fg, weather_fg, lagged_aq_fg, start_time: str | None = None
+) -> pd.DataFrame:
+    """Weather since `start_time` joined with the air quality and lagged air
+    quality of the same (id, date), named as in the training data
+
+    Days without a reading are kept with NaN pm25, so a replayed forecast sees
+    every day the batch inference would see.
+
+    Returns:
+        pd.DataFrame with columns [id, date, weather_..., pm25, lagged_aq_...]"""
+
+    def read(feature_group):
+        if start_time is None:
+            return schema.coerce(feature_group.read())
+        return schema.coerce(
+            feature_group.filter(feature_group.date >= start_time).read()
+        )
+
+    weather = read(weather_fg)
+    weather = weather.rename(
+        columns={col: "weather_" + col for col in weather.columns.drop(["id", "date"])}
+    )
+    return asof_join(
+        weather,
+        [
+            (read(air_quality_fg)[["id", "date", "pm25"]], ""),
+            (read(lagged_aq_fg), "lagged_aq_"),
+        ],
+        how="left",
+    )
+
+
+def forecast_origins(
+    history: pd.DataFrame, days: int, horizon_days: int = HORIZON_DAYS
+) -> pd.DatetimeIndex:
+    """The last `days` forecast dates whose whole horizon is in `history`"""
+    last_day = pd.to_datetime(history["date"]).dt.tz_localize(None).max().normalize()
+    return pd.date_range(
+        end=last_day - pd.Timedelta(days=horizon_days), periods=days, freq="D"
+    )
+
+
+# Backtest state of a worker, set once per worker
+_backtest = None
+
+
+def _init_worker(model, history, days, feature_columns, feature_names, horizon_days):
+    global _backtest
+    if hasattr(model, "set_params"):
+        # Origins run in parallel processes, not threads
+        model.set_params(n_jobs=1)
+    _backtest = (model, history, days, feature_columns, feature_names, horizon_days)
+
+
+def _replay(origin: np.datetime64) -> pd.DataFrame:
+    """Recursive forecast made on `origin`, as the batch inference would have"""
+    model, history, days, feature_columns, feature_names, horizon_days = _backtest
+    first_day = origin + np.timedelta64(1, "D")
+    start, end = np.searchsorted(
+        days, [first_day, first_day + np.timedelta64(horizon_days, "D")]
+    )
+    batch = history.iloc[start:end].copy()
+    # Lags are only known for the day after the forecast date
+    later_days = days[start:end] > first_day
+    batch.loc[later_days, forecast.LAG_COLUMNS] = np.nan
+    batch["predicted_pm25"] = forecast.recursive_forecast(
+        model,
+        batch,
+        feature_columns,
+        lag_columns=forecast.LAG_COLUMNS,
+        feature_names=feature_names,
+    )
+    batch["forecast_on"] = pd.Timestamp(origin).date()
+    batch["lead_days"] = ((days[start:end] - origin) // np.timedelta64(1, "D")).astype(
+        "int16"
+    )
+    return batch[["date", "id", "predicted_pm25", "forecast_on", "pm25", "lead_days"]]
+
+
+def run_backtest(
+    model,
+    history: pd.DataFrame,
+    origins,
+    feature_names: list[str],
+    horizon_days: int = HORIZON_DAYS,
+    max_workers: int | None = None,
+) -> pd.DataFrame:
+    """Replay the daily recursive forecast from many historical forecast dates
+
+    Each origin only sees the lags known on the day after it and feeds its
+    predictions into later lags, as the batch inference does, so the errors
+    are those of real forecasts rather than of one-day-ahead predictions from
+    true lags. Weather is the archived weather of each day, not the forecast
+    made on the origin. Origins are replayed in parallel processes.
+
+    Arguments:
+        model: regressor with a `predict` method
+        history: rows with [id, date, pm25, weather_..., lagged_aq_...],
+            see `read_history`
+        origins: dates the forecasts are made on
+        feature_names: names of the features as the model expects them
+        horizon_days: days forecasted from each origin
+        max_workers: number of processes, defaults to the number of CPUs
+
+    Returns:
+        pd.DataFrame shaped as the air_quality_forecasts feature group, with
+        the actual pm25 and the lead time in days of every forecast
+    """
+    history = history.assign(
+        date=pd.to_datetime(history["date"]).dt.tz_localize(None).dt.normalize()
+    ).sort_values(["date", "id"], kind="stable")
+    days = history["date"].to_numpy()
+    feature_columns = [
+        name if name in history.columns else "lagged_aq_" + name
+        for name in feature_names
+    ]
+    origins = pd.to_datetime(origins).to_numpy(dtype="datetime64[ns]")
+    max_workers = max_workers or os.cpu_count() or 1
+    with process_pool(
+        max_workers,
+        initializer=_init_worker,
+        initargs=(model, history, days, feature_columns, feature_names, horizon_days),
+    ) as executor:
+        replays = list(
+            executor.map(
+                _replay, origins, chunksize=max(1, len(origins) // (4 * max_workers))
+            )
+        )
+    backtest = pd.concat(replays, ignore_index=True)
+    backtest["date"] = backtest["date"].dt.date
+    return backtest
+
+
+def lead_time_errors(
+    backtest: pd.DataFrame, by: tuple[str, ...] = ("lead_days",)
+) -> pd.DataFrame:
+    """Forecast errors per lead time, or per any other columns of `backtest`
+
+    Returns:
+        pd.DataFrame with the number of forecasts with an actual reading and
+        their MAE, RMSE and bias (mean of predicted minus actual)"""
+    by = list(by)
+    error = backtest["predicted_pm25"] - backtest["pm25"]
+    errors = backtest[by].assign(
+        error=error, abs_error=error.abs(), squared_error=error**2
+    )
+    table = (
+        errors.dropna(subset=["error"])
+        .groupby(by, observed=True)
+        .agg(
+            n=("error", "size"),
+            MAE=("abs_error", "mean"),
+            RMSE=("squared_error", "mean"),
+            bias=("error", "mean"),
+        )
+    )
+    table["RMSE"] = np.sqrt(table["RMSE"])
+    return table.reset_index()
@@ -0,0 +1,68 @@
+# %%
+# Backtest the daily recursive forecast: replay it from every day of the past
+# year and measure its error per lead time, as the forecasts would have been
+import os
+import argparse
+import datetime
+import hops
+import backtest
+import model_cache
+from dotenv import load_dotenv
+
+load_dotenv()
+
+parser = argparse.ArgumentParser(description="Backtest the air quality forecast")
+parser.add_argument(
+    "--days", type=int, default=365, help="number of forecast dates to replay"
+)
+parser.add_argument(
+    "--horizon-days",
+    type=int,
+    default=backtest.HORIZON_DAYS,
+    help="days forecasted from each date",
+)
+parser.add_argument(
+    "--model-version", type=int, default=7, help="version of the model to backtest"
+)
+parser.add_argument(
+    "--max-workers", type=int, default=None, help="number of processes"
+)
+# Ignore arguments of interactive kernels
+args, _ = parser.parse_known_args()
+
+# %%
+project = hops.Project(name="ostergotland_air_quality")
+model, feature_names = model_cache.get_model(
+    project.model_registry, name="air_quality_xgboost_model", version=args.model_version
+)
+air_quality_fg, weather_fg, lagged_air_quality_fg = project.get_feature_groups(
+    [("air_quality", 2), ("weather", 2), ("air_quality_lagged", 3)]
+)
+start_time = (
+    datetime.date.today() - datetime.timedelta(days=args.days + args.horizon_days + 1)
+).strftime("%Y-%m-%d")
+history = backtest.read_history(
+    air_quality_fg, weather_fg, lagged_air_quality_fg, start_time
+)
+history.info()
+
+# %%
+backtest_forecasts = backtest.run_backtest(
+    model,
+    history,
+    backtest.forecast_origins(history, args.days, args.horizon_days),
+    feature_names,
+    horizon_days=args.horizon_days,
+    max_workers=args.max_workers,
+)
+errors = backtest.lead_time_errors(backtest_forecasts)
+print(errors)
+
+# %%
+backtest_dir = "model/backtest"
+os.makedirs(backtest_dir, exist_ok=True)
+backtest_forecasts.to_parquet(backtest_dir + "/forecasts.parquet", index=False)
+errors.to_csv(backtest_dir + "/lead_time_errors.csv", index=False)
+backtest.lead_time_errors(backtest_forecasts, by=("id", "lead_days")).to_csv(
+    backtest_dir + "/sensor_lead_time_errors.csv", index=False
+)
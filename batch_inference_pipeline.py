@@ -1,11 +1,49 @@
 # %%
 import hops
+import argparse
 import datetime
-from xgboost import XGBRegressor
+import inference
 import json
+import pandas as pd
+import schema
+import snapshot
 from dotenv import load_dotenv
 
 load_dotenv()
+
+parser = argparse.ArgumentParser(description="Forecast air quality")
+parser.add_argument(
+    "--direct-version",
+    type=int,
+    default=None,
+    help="forecast with this version of the direct models, one per horizon, "
+    "instead of feeding predictions back day by day",
+)
+parser.add_argument(
+    "--shards",
+    type=int,
+    default=1,
+    help="partition the sensors into this many shards, each forecasted in its "
+    "own process",
+)
+parser.add_argument(
+    "--shard-index",
+    type=int,
+    default=None,
+    help="only forecast this shard of --shards, to spread the shards over "
+    "several jobs",
+)
+parser.add_argument(
+    "--max-workers",
+    type=int,
+    default=None,
+    help="processes forecasting shards, defaults to one per shard",
+)
+# Ignore arguments of interactive kernels
+args, _ = parser.parse_known_args()
+if args.shard_index is not None and not 0 <= args.shard_index < args.shards:
+    parser.error("--shard-index must be between 0 and --shards - 1")
+
 # %%
 # Load places
 with open("places.json") as plf:
@@ -15,112 +53,52 @@ places
 
 # %%
 project = hops.Project(name="ostergotland_air_quality")
-mr = project.model_registry
-
-retrieved_model = mr.get_model(name="air_quality_xgboost_model", version=7)
-
-fv = retrieved_model.get_feature_view()
-# Download the saved model artifacts to a local directory
-saved_model_dir = retrieved_model.download()
-# Loading the XGBoost regressor model and label encoder from the saved model directory
-retrieved_xgboost_model = XGBRegressor()
-retrieved_xgboost_model.load_model(saved_model_dir + "/model.json")
-# Displaying the retrieved XGBoost regressor model
-retrieved_xgboost_model
-
+today = datetime.date.today()
+shards = inference.shard_ids(list(places), args.shards)
 
 # %%
-today = datetime.date.today().strftime("%Y-%m-%d")
-
-# Get and clean feature view
-
-fs = project.feature_store
-weather_fg, lagged_air_quality_fg = project.get_feature_groups(
-    [
-        (
-            "weather",
-            2,
-        ),
-        (
-            "air_quality_lagged",
-            3,
-        ),
-    ]
-)
-
-selected_features = weather_fg.select_all().join(
-    lagged_air_quality_fg.select_all(), on="id", prefix="lagged_aq_"
-)
-
-feature_view = project.feature_store.get_or_create_feature_view(
-    name="weather_plus_lagged_air_quality_inf_fv",
-    description="",
-    version=3,
-    inference_helper_columns=["id"],
-    training_helper_columns=["id"],
-    query=selected_features,
-)
-# %%
-# Get batch weather and lagged air quality data for tomorrow onwards
-tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-batch_data = feature_view.get_batch_data(start_time=tomorrow)
-batch_data.drop(columns=["lagged_aq_date"], inplace=True)
-batch_data.rename(columns={"lagged_aq_id": "id"}, inplace=True)
-# Set lagged data from day after tomorrow to NaN
-# Since we don't actually have that data, the join just adds the latest available
-for lag_col in batch_data.columns:
-    if lag_col.startswith("lagged_aq_"):
-        batch_data.loc[
-            batch_data["date"] > (datetime.date.today() + datetime.timedelta(days=1)),
-            lag_col,
-        ] = None
-batch_data["predicted_pm25"] = None
-batch_data["predicted_pm25"] = batch_data["predicted_pm25"].astype("float32")
-batch_data.info()
-# %%
-for day in batch_data["date"].unique():
-    print("Processing day:", day)
-    mask_day = batch_data["date"] == day
-    predicted = retrieved_xgboost_model.predict(
-        batch_data[mask_day]
-        .drop(columns=["date", "id", "predicted_pm25"])
-        .rename(
-            columns={
-                col: "weather_" + col
-                for col in batch_data[mask_day].columns
-                if not col.startswith("lagged_aq_")
-            },
-        )
+# Weather and lagged air quality are read for tomorrow onwards, each day's
+# prediction becomes the next day's lagged data, or with direct models every
+# day is predicted at once from the lags known for tomorrow
+if args.shard_index is not None:
+    # One shard of several jobs, forecasted in this process
+    model, feature_names = inference.load_model(
+        project.model_registry, direct_version=args.direct_version
     )
-    predicted = predicted.astype(float)
-    batch_data.loc[mask_day, "predicted_pm25"] = predicted
-    # Take the weather forecast for tomorrow
-    if day == batch_data["date"].max():
-        continue
-    next_day = day + datetime.timedelta(days=1)
-    mask_next = batch_data["date"] == next_day
-    # pm25 lagged_1d for tomorrow = predicted_pm25 for today
-    batch_data.loc[mask_next, "lagged_aq_pm25_lagged_1d"] = batch_data.loc[
-        mask_day, "predicted_pm25"
-    ].values
-    batch_data.loc[mask_next, "lagged_aq_pm25_lagged_2d"] = batch_data.loc[
-        mask_day, "lagged_aq_pm25_lagged_1d"
-    ].values
-    batch_data.loc[mask_next, "lagged_aq_pm25_lagged_3d"] = batch_data.loc[
-        mask_day, "lagged_aq_pm25_lagged_2d"
-    ].values
-# %%
-# Save forecasts to separate feature group
-batch_data = batch_data[["date", "id", "predicted_pm25"]]
-batch_data["forecast_on"] = datetime.date.today()
-batch_data.head()
+    forecasts = inference.forecast_places(
+        project, model, feature_names, today, shards[args.shard_index]
+    )
+elif args.shards > 1:
+    # Shards are forecasted in worker processes, each loading the model once
+    forecasts = inference.forecast_shards(
+        project.project_name,
+        shards,
+        today,
+        direct_version=args.direct_version,
+        max_workers=args.max_workers,
+    )
+else:
+    model, feature_names = inference.load_model(
+        project.model_registry, direct_version=args.direct_version
+    )
+    forecasts = inference.forecast_places(project, model, feature_names, today)
+forecasts.head()
 
 # %%
-forecasts_fg = fs.get_or_create_feature_group(
+# Save the forecasts of all shards to separate feature group in one insert
+forecasts_fg = project.feature_store.get_or_create_feature_group(
     name="air_quality_forecasts",
     description="Forecasted Air Quality for performance measurements",
     version=3,
     primary_key=["id", "date"],
     event_time="forecast_on",
 )
-forecasts_fg.insert(batch_data)
+forecasts_fg.insert(schema.to_storage(schema.validate(forecasts)))
+
+# %%
+# Snapshot of recent readings and forecasts for the dashboard, including the
+# forecasts just inserted. Shard jobs only know their own forecasts, so the
+# snapshot is left to a full run
+if args.shard_index is None:
+    aq_df, forecast_df = snapshot.read_sources(project, today)
+    snapshot.write(snapshot.build(aq_df, pd.concat([forecast_df, forecasts])))
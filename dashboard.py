@@ -1,49 +1,71 @@
 import json
+import logging
+import math
+import os
 
 import streamlit as st
-import datetime
 import plotly.graph_objects as go
 import pandas as pd
+import helper
 import hops
+import monitoring
+import snapshot
 from dotenv import load_dotenv
 
 load_dotenv()  # API key to Hopsworks
 
+logger = logging.getLogger(__name__)
+
+# Points per trace, about the width of a chart in pixels
+POINT_BUDGET = 800
+# Sensors per page when browsing all sensors
+PAGE_SIZE = 10
+
+
+def load_data() -> dict[str, tuple[pd.DataFrame, pd.DataFrame]]:
+    """Load air quality records and predictions of each sensor from the snapshot
+    written by the batch inference, or from Hopsworks if there is none yet"""
+    try:
+        return snapshot.load()
+    except OSError:
+        project = hops.Project(name="ostergotland_air_quality")
+        return snapshot.by_sensor(snapshot.build(*snapshot.read_sources(project)))
+
+
+@st.cache_resource
+def data_cache() -> snapshot.StaleWhileRevalidate:
+    """Data shared by all sessions, reloaded in the background every 10 minutes"""
+    return snapshot.StaleWhileRevalidate(load_data, ttl=600)
 
-@st.cache_data
-def load_data() -> tuple[pd.DataFrame, pd.DataFrame]:
-    """Load air quality records and predictions from Hopsworks"""
-    project = hops.Project(name="ostergotland_air_quality")
-    air_quality_fg, forecast_fg = project.get_feature_groups(
-        [("air_quality", 2), ("air_quality_forecasts", 3)]
-    )
-    # Only load historical data for the last 14 days
-    last_14_days_filter = air_quality_fg.date >= (
-        datetime.date.today() - datetime.timedelta(days=14)
-    ).strftime("%Y-%m-%d")
-    next_14_days_filter = forecast_fg.date <= (
-        datetime.date.today() + datetime.timedelta(days=14)
-    ).strftime("%Y-%m-%d")
-    aq_df = air_quality_fg.filter(last_14_days_filter).read().sort_values(by="date")
-    forecast_df = (
-        forecast_fg.filter(last_14_days_filter and next_14_days_filter)
-        .read()
-        .sort_values(by="date")
-    )
-    return (
-        aq_df,
-        forecast_df,
-    )
+
+def load_accuracy() -> dict[str, pd.DataFrame]:
+    """Load the rolling forecast errors of each sensor from the snapshot written
+    by the monitoring pipeline, or from Hopsworks if there is none yet"""
+    try:
+        accuracy = pd.read_parquet(
+            os.environ.get("DASHBOARD_ACCURACY", snapshot.ACCURACY_FILE)
+        )
+    except OSError:
+        project = hops.Project(name="ostergotland_air_quality")
+        (metrics_fg,) = project.get_feature_groups([monitoring.METRICS_FG])
+        accuracy = monitoring.read_accuracy(metrics_fg)
+    accuracy["id"] = accuracy["id"].astype(str)
+    return dict(tuple(accuracy.sort_values("date").groupby("id")))
+
+
+@st.cache_resource
+def accuracy_cache() -> snapshot.StaleWhileRevalidate:
+    """Accuracy shared by all sessions, reloaded in the background every hour"""
+    return snapshot.StaleWhileRevalidate(load_accuracy, ttl=3600)
 
 
-def add_forecast_diff(df_forecast: pd.DataFrame) -> pd.DataFrame:
-    """Add column "forecast_days_before" to indicate
-    how many days before the reading the forecast was made"""
-    df_forecast["forecast_days_before"] = (
-        df_forecast["forecast_on"] - df_forecast["date"]
-    ).map(lambda x: abs(x.days))
-    df_forecast["forecast_days_before"] = df_forecast["forecast_days_before"]
-    return df_forecast
+def downsample(df: pd.DataFrame, col: str, budget: int = POINT_BUDGET) -> pd.DataFrame:
+    """Rows of `df` kept by LTTB downsampling of `col` over date"""
+    df = df.dropna(subset=[col])
+    if len(df) <= budget:
+        return df
+    x = pd.to_datetime(df["date"]).to_numpy().astype("int64")
+    return df.iloc[helper.lttb(x, df[col].to_numpy(), budget)]
 
 
 def create_plot(
@@ -56,9 +78,12 @@ def create_plot(
     if forecast_days is None:
         forecast_days = (1, 4, 9)
     fig = go.Figure()
+    # WebGL traces of series downsampled to the chart width keep the page light
+    # however long the history is
+    df_air_quality = downsample(df_air_quality, "pm25")
     # Add historical data
     fig.add_trace(
-        go.Scatter(
+        go.Scattergl(
             x=df_air_quality["date"],
             y=df_air_quality["pm25"],
             mode="lines",
@@ -67,11 +92,11 @@ def create_plot(
     )
     # Add forecast data
     for days in forecast_days:
-        forecast_days_in_advance = df_forecast[
-            df_forecast["forecast_days_before"] == days
-        ]
+        forecast_days_in_advance = downsample(
+            df_forecast[df_forecast["forecast_days_before"] == days], "predicted_pm25"
+        )
         fig.add_trace(
-            go.Scatter(
+            go.Scattergl(
                 x=forecast_days_in_advance["date"],
                 y=forecast_days_in_advance["predicted_pm25"],
                 mode="lines",
@@ -90,6 +115,31 @@ def create_plot(
     st.plotly_chart(fig, width="stretch")
 
 
+def create_accuracy_plot(
+    df_accuracy: pd.DataFrame,
+    forecast_days: tuple[int] = (1, 4, 9),
+    window: int = min(monitoring.WINDOW_DAYS),
+) -> None:
+    """Display the rolling mean absolute error of forecasts in Streamlit"""
+    fig = go.Figure()
+    for days in forecast_days:
+        accuracy_days_in_advance = df_accuracy[df_accuracy["lead_days"] == days]
+        fig.add_trace(
+            go.Scattergl(
+                x=accuracy_days_in_advance["date"],
+                y=accuracy_days_in_advance[f"mae_{window}d"],
+                mode="lines",
+                name=f"{window} day MAE ({days} days before)",
+            )
+        )
+    fig.update_layout(
+        xaxis_title="Date",
+        yaxis_title="PM2.5 mean absolute error",
+        hovermode="x unified",
+    )
+    st.plotly_chart(fig, width="stretch")
+
+
 with open("places.json") as f:
     places = json.load(f)
 
@@ -107,12 +157,39 @@ st.text(
     """
 )
 data_load_state = st.text("Loading data...")
-historical_data, forecast_data = load_data()
-forecast_data = add_forecast_diff(forecast_data)
+data_by_place = data_cache().get()
 data_load_state.text("")
 
-for place in places.values():
-    selected_place = place["id"]
-    hist_for_place = historical_data[historical_data["id"] == selected_place]
-    forecast_for_place = forecast_data[forecast_data["id"] == selected_place]
+no_data = (
+    pd.DataFrame(columns=["date", "pm25"]),
+    pd.DataFrame(columns=["date", "predicted_pm25", "forecast_days_before"]),
+)
+# Only the picked sensors, or one page of sensors, are rendered
+view = st.sidebar.radio("Show", ["Picked sensors", "All sensors, by page"])
+if view == "Picked sensors":
+    picked = st.sidebar.multiselect(
+        "Sensors",
+        list(places),
+        default=list(places)[:PAGE_SIZE],
+        format_func=lambda key: f"{places[key]['city']} ({places[key]['street']})",
+    )
+    shown_places = [places[key] for key in picked]
+else:
+    page = st.sidebar.number_input(
+        "Page", min_value=1, max_value=max(1, math.ceil(len(places) / PAGE_SIZE))
+    )
+    shown_places = list(places.values())[(page - 1) * PAGE_SIZE : page * PAGE_SIZE]
+
+try:
+    accuracy_by_place = accuracy_cache().get()
+except OSError as e:
+    # Accuracy is optional, e.g. before the monitoring pipeline first ran
+    logger.warning("Forecast accuracy is not available: %s", e)
+    accuracy_by_place = {}
+
+for place in shown_places:
+    hist_for_place, forecast_for_place = data_by_place.get(str(place["id"]), no_data)
     create_plot(place, hist_for_place, forecast_for_place)
+    if str(place["id"]) in accuracy_by_place:
+        with st.expander("Forecast accuracy"):
+            create_accuracy_plot(accuracy_by_place[str(place["id"])])
@@ -2,14 +2,14 @@
 # weather prediction for the next 7-10 days and update the Feature Groups in Hopsworks. Use GH Actions or Modal.
 
 # %%
-import os
 import json
 
 import hops
 import pandas as pd
 from datetime import date, timedelta
+import aqicn
 import helper
-import requests
+import schema
 import weather
 from dotenv import load_dotenv
 
@@ -23,27 +23,7 @@ places
 
 # %%
 # Get today's air quality for all places
-aq_df = pd.DataFrame(columns=["id", "date", "pm25"])
-for place in places:
-    aqicn_url = (
-        f"https://api.waqi.info/feed/{place}/?token={os.environ['AQICN_ORG_API_TOKEN']}"
-    )
-    resp = requests.get(aqicn_url)
-    resp.raise_for_status()
-    data = resp.json()["data"]
-
-    new_row = pd.DataFrame(
-        [
-            {
-                "id": place,
-                "date": pd.to_datetime(data["time"]["iso"]).date(),
-                "pm25": float(data["iaqi"]["pm25"]["v"]),
-            }
-        ]
-    )
-    aq_df = pd.concat([aq_df, new_row], ignore_index=True)
-
-aq_df["pm25"] = aq_df["pm25"].astype("float32")
+aq_df = aqicn.get_current_pm25(places)
 
 aq_df.head(10)
 
@@ -57,8 +37,8 @@ project = hops.Project(name="ostergotland_air_quality")
 air_quality_fg, weather_fg, lagged_aq_fg = project.get_feature_groups(
     [("air_quality", 2), ("weather", 2), ("air_quality_lagged", 3)]
 )
-air_quality_fg.insert(aq_df)
-weather_fg.insert(weather_df)
+air_quality_fg.insert(schema.to_storage(schema.validate(aq_df, places)))
+weather_fg.insert(schema.to_storage(schema.validate(weather_df, places)))
 
 # %%
 lagged_test_df = lagged_aq_fg.read()
@@ -71,8 +51,10 @@ lagged_test_df[lagged_test_df["id"] == "@13986"].tail(10)
 # Insert lagged air quality data
 lagged_timestamp = (date.today() - timedelta(days=3)).strftime("%Y-%m-%d")
 recent_aq_df = air_quality_fg.filter(
-    lagged_timestamp <= air_quality_fg.date < date.today().strftime("%Y-%m-%d")
+    (air_quality_fg.date >= lagged_timestamp)
+    & (air_quality_fg.date < date.today().strftime("%Y-%m-%d"))
 ).read()
+recent_aq_df = schema.coerce(recent_aq_df, places)
 recent_aq_df.tail(10)
 
 # %%
@@ -84,11 +66,9 @@ lagged_aq_df = pd.concat([recent_aq_df, aq_df, fake_aq_tomorrow], ignore_index=T
 lagged_aq_df.tail(15)
 # %%
 # Add lagged data
-lagged_aq_df = helper.add_lagged_data(lagged_aq_df, "pm25", by_days=1)
-lagged_aq_df = helper.add_lagged_data(lagged_aq_df, "pm25", by_days=2)
-lagged_aq_df = helper.add_lagged_data(lagged_aq_df, "pm25", by_days=3)
+lagged_aq_df = helper.add_lagged_features(lagged_aq_df, "pm25", lags=(1, 2, 3))
 lagged_aq_df.drop(columns=["pm25"], inplace=True)
-lagged_aq_df["date"] = pd.to_datetime(lagged_aq_df["date"]).dt.date
+lagged_aq_df = schema.coerce(lagged_aq_df, places)
 # %%
 tomorrows_lagged_aq_df = lagged_aq_df[
     lagged_aq_df["date"] == lagged_aq_df["date"].max()
@@ -97,6 +77,8 @@ tomorrows_lagged_aq_df.tail(20)
 # %%
 lagged_aq_df[lagged_aq_df["id"] == "@13986"].tail(10)
 # %%
-lagged_aq_fg.insert(tomorrows_lagged_aq_df)
+lagged_aq_fg.insert(
+    schema.to_storage(schema.validate(tomorrows_lagged_aq_df, places))
+)
 
 # %%
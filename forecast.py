@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Lagged pm25 columns of the feature views, most recent first
+LAG_COLUMNS = [
+    "lagged_aq_pm25_lagged_1d",
+    "lagged_aq_pm25_lagged_2d",
+    "lagged_aq_pm25_lagged_3d",
+]
+
+
+def recursive_forecast(
+    model,
+    batch_data: pd.DataFrame,
+    feature_columns: list[str],
+    lag_columns: list[str] = LAG_COLUMNS,
+    feature_names: list[str] | None = None,
+) -> np.ndarray:
+    """Forecast day by day, feeding each day's predictions into the next day's lags
+
+    The features are laid out once as a dense (day x sensor x feature) array,
+    so every day is a single predict on a contiguous block, and lags are
+    carried forward per sensor id rather than by row order.
+
+    Arguments:
+        model: regressor with a `predict` method
+        batch_data: rows with [date, id, feature_columns...]
+        feature_columns: columns passed to the model, in this order
+        lag_columns: lagged prediction target columns, most recent first
+        feature_names: names of the features as the model expects them,
+            defaults to `feature_columns`
+
+    Returns:
+        np.ndarray of predictions, one per row of `batch_data`
+    """
+    feature_names = feature_names or feature_columns
+    days, day_idx = np.unique(pd.to_datetime(batch_data["date"]), return_inverse=True)
+    ids, id_idx = np.unique(batch_data["id"].to_numpy(dtype=str), return_inverse=True)
+    lag_pos = [feature_columns.index(col) for col in lag_columns]
+
+    features = np.full((len(days), len(ids), len(feature_columns)), np.nan, "float32")
+    features[day_idx, id_idx] = batch_data[feature_columns].to_numpy(dtype="float32")
+    present = np.zeros((len(days), len(ids)), dtype=bool)
+    present[day_idx, id_idx] = True
+    predictions = np.full((len(days), len(ids)), np.nan, dtype="float32")
+
+    for day in range(len(days)):
+        block = features[day, present[day]]
+        predictions[day, present[day]] = model.predict(
+            pd.DataFrame(block, columns=feature_names)
+        )
+        if day + 1 == len(days) or days[day + 1] - days[day] != np.timedelta64(1, "D"):
+            continue
+        # The lag k+1 of tomorrow is lag k of today, lag 1 is today's prediction
+        for k in range(len(lag_pos) - 1, 0, -1):
+            features[day + 1, :, lag_pos[k]] = features[day, :, lag_pos[k - 1]]
+        features[day + 1, :, lag_pos[0]] = predictions[day]
+
+    return predictions[day_idx, id_idx]
+
+
+def direct_forecast(
+    models: dict,
+    batch_data: pd.DataFrame,
+    feature_columns: list[str],
+    forecast_on,
+    lag_columns: list[str] = LAG_COLUMNS,
+    feature_names: list[str] | None = None,
+    max_workers: int | None = None,
+) -> np.ndarray:
+    """Forecast every day at once with one model per forecast horizon
+
+    The lags of each sensor are those known on the day after `forecast_on`, a
+    row h days after `forecast_on` is predicted by the model of horizon h from
+    its own weather and these lags. Horizons are predicted in parallel threads.
+
+    Arguments:
+        models: dict of horizon in days to a regressor with a `predict` method
+        batch_data: rows with [date, id, feature_columns...]
+        feature_columns: columns passed to the models, in this order
+        forecast_on: date the forecast is made on
+        lag_columns: lagged prediction target columns, most recent first
+        feature_names: names of the features as the models expect them,
+            defaults to `feature_columns`
+        max_workers: number of threads, defaults to one per horizon
+
+    Returns:
+        np.ndarray of predictions, one per row of `batch_data`, NaN for rows
+        without a model for their horizon
+    """
+    feature_names = feature_names or feature_columns
+    dates = pd.to_datetime(batch_data["date"]).dt.tz_localize(None).dt.normalize()
+    horizons = (dates - pd.Timestamp(forecast_on)).dt.days.to_numpy()
+    features = batch_data[feature_columns].to_numpy(dtype="float32")
+
+    # Replace the lags of every row with the lags known for the first day
+    ids = batch_data["id"].to_numpy(dtype=str)
+    first_day = horizons == 1
+    known_lags = pd.DataFrame(
+        features[first_day][:, [feature_columns.index(col) for col in lag_columns]],
+        index=ids[first_day],
+    )
+    known_lags = known_lags[~known_lags.index.duplicated()]
+    features[:, [feature_columns.index(col) for col in lag_columns]] = (
+        known_lags.reindex(ids).to_numpy()
+    )
+
+    predictions = np.full(len(batch_data), np.nan, dtype="float32")
+
+    def predict(horizon):
+        rows = np.flatnonzero(horizons == horizon)
+        if len(rows):
+            predictions[rows] = models[horizon].predict(
+                pd.DataFrame(features[rows], columns=feature_names)
+            )
+
+    with ThreadPoolExecutor(max_workers or len(models) or 1) as executor:
+        list(executor.map(predict, models))
+    return predictions
@@ -1,5 +1,14 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 
+ROLLING_STATS = ("mean", "min", "max")
+
+
 def add_lagged_data(df: pd.DataFrame, col_to_shift: str, by_days: int) -> pd.DataFrame:
     """
     Adds a column to each row that contains the value of `col_to_shift`
@@ -10,7 +19,245 @@ def add_lagged_data(df: pd.DataFrame, col_to_shift: str, by_days: int) -> pd.Dat
         col_to_shift (str): Column name to lag the values of.
         by_days (int): Number of days to lag the data for.
     """
-    df = df.sort_values(by=['id', 'date'])
-    df[f'{col_to_shift}_lagged_{by_days}d'] = df.groupby('id')[col_to_shift].shift(by_days)
-    df = df.sort_values(by=['date', 'id'])
-    return df
+    return add_lagged_features(df, col_to_shift, lags=[by_days])
+
+
+def add_lagged_features(
+    df: pd.DataFrame,
+    col: str,
+    lags: tuple[int, ...] = (1, 2, 3),
+    windows: tuple[int, ...] = (),
+    stats: tuple[str, ...] = ROLLING_STATS,
+) -> pd.DataFrame:
+    """
+    Adds lagged and rolling window columns of `col` to each row in one pass.
+
+    Values are aligned on calendar dates per id, so a missing day yields NaN
+    instead of silently pulling in an older reading. Each id gets its own
+    contiguous block of a dense day grid (padded by the largest lag/window),
+    which turns every lag into a constant offset and every window into a
+    plain rolling aggregate, without any per-id sorting.
+
+    Args:
+        df (pd.DataFrame): DataFrame containing rows with different dates and ids.
+        col (str): Column name to lag the values of.
+        lags (tuple[int]): Numbers of days to lag the data for, adds
+            `{col}_lagged_{k}d` columns.
+        windows (tuple[int]): Window sizes in days, adds `{col}_rolling_{stat}_{k}d`
+            columns aggregating the `k` days before each row's date.
+        stats (tuple[str]): Aggregates to compute for each window, any of
+            "mean", "min" and "max".
+
+    Returns:
+        pd.DataFrame: copy of `df` with the new columns, sorted by date and id,
+        with only the last row of duplicate (id, date) rows
+
+    Raises:
+        ValueError: for unknown stats, or lags or windows that are not positive
+    """
+    unknown_stats = set(stats) - set(ROLLING_STATS)
+    if unknown_stats:
+        raise ValueError(f"Unknown rolling stats: {sorted(unknown_stats)}")
+    # Lags and windows must look back, or they would read into the next id's block
+    not_positive = sorted(k for k in [*lags, *windows] if k <= 0)
+    if not_positive:
+        raise ValueError(f"Lags and windows must be positive days: {not_positive}")
+
+    df = df.copy()
+    values = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype="float64")
+    out_dtype = df[col].dtype if pd.api.types.is_float_dtype(df[col]) else "float64"
+    days = (
+        pd.to_datetime(df["date"], utc=True)
+        .dt.tz_localize(None)
+        .dt.floor("D")
+        .to_numpy()
+        .astype("datetime64[D]")
+        .astype("int64")
+    )
+    codes, ids = pd.factorize(df["id"])
+    # The grid holds one value per id and day, keep the last row of each
+    duplicated = pd.DataFrame({"id": codes, "day": days}).duplicated(keep="last")
+    if duplicated.any():
+        keep = ~duplicated.to_numpy()
+        df, values, days, codes = df[keep], values[keep], days[keep], codes[keep]
+    if len(df.index) == 0:
+        for k in lags:
+            df[f"{col}_lagged_{k}d"] = pd.Series(dtype=out_dtype)
+        for k in windows:
+            for stat in stats:
+                df[f"{col}_rolling_{stat}_{k}d"] = pd.Series(dtype=out_dtype)
+        return df
+
+    # Lay out every id on its own block of consecutive days, preceded by `pad`
+    # empty days so that offsets never read into the previous id's block
+    pad = max([*lags, *windows, 1])
+    first_day = np.full(len(ids), np.iinfo("int64").max)
+    last_day = np.full(len(ids), np.iinfo("int64").min)
+    np.minimum.at(first_day, codes, days)
+    np.maximum.at(last_day, codes, days)
+    block_len = last_day - first_day + 1 + pad
+    block_start = np.concatenate(([0], np.cumsum(block_len)[:-1]))
+    pos = block_start[codes] + pad + (days - first_day[codes])
+
+    grid = np.full(int(block_len.sum()), np.nan)
+    grid[pos] = values
+
+    for k in lags:
+        df[f"{col}_lagged_{k}d"] = grid[pos - k].astype(out_dtype)
+
+    grid_series = pd.Series(grid)
+    for k in windows:
+        rolling = grid_series.rolling(k, min_periods=1)
+        for stat in stats:
+            # Aggregate at the previous day covers the k days before each row
+            aggregated = getattr(rolling, stat)().to_numpy()
+            df[f"{col}_rolling_{stat}_{k}d"] = aggregated[pos - 1].astype(out_dtype)
+
+    return df.sort_values(by=["date", "id"], kind="stable")
+
+
+class RateLimiter:
+    """Thread-safe token bucket allowing `rate` calls per second on average,
+    with bursts of up to `burst` calls"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available and take it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def process_pool(max_workers: int | None = None, **kwargs) -> ProcessPoolExecutor:
+    """Process pool safe to use from the pipeline scripts
+
+    The pipelines are plain scripts without a `__main__` guard, which spawned
+    workers would run again on import, so workers are forked where possible."""
+    start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context(start_method),
+        **kwargs,
+    )
+
+
+def asof_join(
+    left: pd.DataFrame,
+    rights: list[tuple[pd.DataFrame, str]],
+    tolerance_days: int = 0,
+    how: str = "inner",
+) -> pd.DataFrame:
+    """Point-in-time join of frames on (id, date)
+
+    Each row of `left` is matched with the latest row of every right frame with
+    the same id and a date at most `tolerance_days` before its own, using a
+    sorted merge. Rows are deduplicated per (id, date) first, so the result
+    has exactly one row per sensor-day.
+
+    Args:
+        left (pd.DataFrame): frame with [id, date, ...] to add features to
+        rights (list[tuple[pd.DataFrame, str]]): frames with [id, date, ...]
+            and the prefix to add to their other columns
+        tolerance_days (int): how many days older a right row may be
+        how (str): "inner" drops rows without a match in every right frame,
+            "left" keeps them with NaN features
+
+    Returns:
+        pd.DataFrame: columns of `left` and prefixed columns of the right
+        frames, without their id and date, sorted by date and id
+    """
+
+    def day(df: pd.DataFrame) -> pd.Series:
+        return (
+            pd.to_datetime(df["date"], utc=True).dt.tz_localize(None).dt.normalize()
+        )
+
+    joined = (
+        left.assign(_day=day(left))
+        .drop_duplicates(["id", "_day"], keep="last")
+        .sort_values("_day", kind="stable")
+    )
+    for right, prefix in rights:
+        features = right.columns.drop(["id", "date"])
+        right = (
+            right.assign(_day=day(right), _matched=True)
+            .drop_duplicates(["id", "_day"], keep="last")
+            .rename(columns={col: prefix + col for col in features})
+            .drop(columns="date")
+            .sort_values("_day", kind="stable")
+        )
+        if right["id"].dtype != joined["id"].dtype:
+            # Categorical ids only join on identical categories, e.g. sensors
+            # missing from places.json on one side only
+            joined["id"] = joined["id"].astype(str)
+            right["id"] = right["id"].astype(str)
+        joined = pd.merge_asof(
+            joined,
+            right,
+            on="_day",
+            by="id",
+            tolerance=pd.Timedelta(days=tolerance_days),
+            direction="backward",
+        )
+        if how == "inner":
+            joined = joined[joined["_matched"].notna()]
+        joined = joined.drop(columns="_matched")
+    return (
+        joined.sort_values(["_day", "id"], kind="stable")
+        .drop(columns="_day")
+        .reset_index(drop=True)
+    )
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Indices of the points kept by Largest-Triangle-Three-Buckets downsampling
+
+    The first and last points are always kept, the others are split into
+    `n_out - 2` buckets of consecutive points, and from each bucket the point
+    forming the largest triangle with the previously kept point and the mean of
+    the next bucket is kept. Peaks and dips survive, unlike with every k-th point.
+
+    Args:
+        x (np.ndarray): increasing x values, e.g. dates as int64
+        y (np.ndarray): y values without NaN
+        n_out (int): number of points to keep
+
+    Returns:
+        np.ndarray: sorted indices of the kept points, all indices if there are
+        at most `n_out` points
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    kept = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs(
+            (x[kept] - next_x) * (y[start:end] - y[kept])
+            - (x[kept] - x[start:end]) * (next_y - y[kept])
+        )
+        kept = start + int(np.argmax(area))
+        selected[bucket + 1] = kept
+    return selected
@@ -1,26 +1,106 @@
+import os
+import threading
+import time
+from functools import cached_property
+
 import hopsworks
 
+import local_store
+
 # Group name,version
 group = tuple[str, int]
 
+# Logged in projects and feature group/view metadata shared by all Project
+# objects of the process, so repeated accesses don't cost round trips
+_logins = {}
+_metadata_cache = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """Forked workers log in again rather than share the parent's connections"""
+    global _lock
+    _lock = threading.Lock()
+    _logins.clear()
+    _metadata_cache.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
 
 class Project:
-    def __init__(self, name, engine="python"):
+    def __init__(self, name, engine="python", backend=None, cache_ttl=600):
+        """Project on Hopsworks, or stored locally with backend="local"
+
+        Logging in is deferred until the project is first used, and happens
+        once per process. Feature group and feature view metadata is cached
+        for `cache_ttl` seconds, see `invalidate`.
+
+        The backend defaults to the HOPS_BACKEND environment variable, or
+        "hopsworks". Local projects are stored in HOPS_LOCAL_ROOT, by default
+        data/feature-store."""
         self.project_name = name
-        self.project = hopsworks.login(engine=engine, project=name)
+        self.engine = engine
+        self.backend = backend or os.environ.get("HOPS_BACKEND", "hopsworks")
+        if self.backend not in ("hopsworks", "local"):
+            raise ValueError(f"Unknown backend: {self.backend}")
+        self.cache_ttl = cache_ttl
 
     @property
+    def project(self):
+        key = (self.backend, self.project_name, self.engine)
+        with _lock:
+            if key not in _logins:
+                if self.backend == "local":
+                    root = os.environ.get("HOPS_LOCAL_ROOT", "data/feature-store")
+                    _logins[key] = local_store.Project(self.project_name, root)
+                else:
+                    _logins[key] = hopsworks.login(
+                        engine=self.engine, project=self.project_name
+                    )
+            return _logins[key]
+
+    @cached_property
     def feature_store(self):
         return self.project.get_feature_store()
 
-    @property
+    @cached_property
     def model_registry(self):
         return self.project.get_model_registry()
-    
-    @property
+
+    @cached_property
     def feature_api(self):
         return self.project.get_feature_api()
 
+    def _cached(self, kind: str, name: str, version: int, get):
+        """Metadata object from the cache, or from `get()` if missing or expired"""
+        key = (self.backend, self.project_name, kind, name, version)
+        with _lock:
+            cached = _metadata_cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.cache_ttl:
+            return cached[1]
+        value = get()
+        with _lock:
+            _metadata_cache[key] = (time.monotonic(), value)
+        return value
+
+    def invalidate(self, name: str | None = None, version: int | None = None) -> None:
+        """Drop cached feature group and feature view metadata of this project
+
+        Arguments:
+            name: only drop metadata with this name
+            version: only drop metadata with this version
+        """
+        with _lock:
+            for key in list(_metadata_cache):
+                backend, project_name, _kind, cached_name, cached_version = key
+                if (
+                    (backend, project_name) == (self.backend, self.project_name)
+                    and name in (None, cached_name)
+                    and version in (None, cached_version)
+                ):
+                    del _metadata_cache[key]
+
     def get_feature_groups(self, groups: list[group] | None = None) -> tuple:
         """Gets a sequence of feature groups by their names and versions.
 
@@ -31,9 +111,23 @@ class Project:
             tuple of FeatureGroup objects
         """
         return tuple(
-            self.feature_store.get_feature_group(
-                name=name,
-                version=version,
+            self._cached(
+                "feature_group",
+                name,
+                version,
+                lambda: self.feature_store.get_feature_group(
+                    name=name,
+                    version=version,
+                ),
             )
             for (name, version) in groups
         )
+
+    def get_feature_view(self, name: str, version: int):
+        """Gets a feature view by its name and version."""
+        return self._cached(
+            "feature_view",
+            name,
+            version,
+            lambda: self.feature_store.get_feature_view(name=name, version=version),
+        )
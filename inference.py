@@ -0,0 +1,179 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import forecast
+import hops
+import model_cache
+import schema
+import training
+from helper import asof_join, process_pool
+
+# Version of the recursive model used for the daily forecasts
+MODEL_VERSION = 7
+
+
+def load_model(model_registry, version: int = MODEL_VERSION, direct_version=None):
+    """The recursive model, or the bundle of direct models if `direct_version`
+    is given, with the names of their features
+
+    Returns:
+        XGBRegressor, or dict of horizon to XGBRegressor, and list of names"""
+    # Load the model from the local cache, downloading it only if it is not cached yet
+    if direct_version is not None:
+        return model_cache.get_model(
+            model_registry, name=training.DIRECT_MODEL_NAME, version=direct_version
+        )
+    return model_cache.get_model(
+        model_registry, name=training.MODEL_NAME, version=version
+    )
+
+
+def read_batch_data(
+    weather_fg, lagged_aq_fg, start_date: str, ids: list[str] | None = None
+) -> pd.DataFrame:
+    """Weather from `start_date` onwards joined with the lagged air quality on
+    (id, date), only for sensors in `ids` if given
+
+    Lagged data is only known for the first day, so later days get NaN lags
+    that the forecast fills in."""
+
+    def read(feature_group):
+        date_filter = feature_group.date >= start_date
+        if ids is not None:
+            date_filter = date_filter & feature_group.id.isin(ids)
+        return schema.coerce(feature_group.filter(date_filter).read())
+
+    return asof_join(
+        read(weather_fg), [(read(lagged_aq_fg), "lagged_aq_")], how="left"
+    )
+
+
+def model_columns(
+    batch_data: pd.DataFrame, feature_names: list[str] | None
+) -> tuple[list[str], list[str]]:
+    """Columns of `batch_data` holding each feature of the model
+
+    Weather features are named with a prefix in the model, as in the training
+    data, lagged features are named with or without the lagged_aq_ prefix.
+
+    Returns:
+        the columns, and the feature names, all but the prefixed lags if
+        `feature_names` is not given"""
+    columns_by_feature_name = {}
+    for col in batch_data.columns.drop(["date", "id"]):
+        if col.startswith("lagged_aq_"):
+            columns_by_feature_name[col.removeprefix("lagged_aq_")] = col
+            columns_by_feature_name[col] = col
+        else:
+            columns_by_feature_name["weather_" + col] = col
+    feature_names = feature_names or [
+        name for name in columns_by_feature_name if not name.startswith("lagged_aq_")
+    ]
+    return [columns_by_feature_name[name] for name in feature_names], feature_names
+
+
+def predict(
+    model, batch_data: pd.DataFrame, feature_names: list[str] | None, forecast_on
+) -> np.ndarray:
+    """Forecast pm25 for every row of `batch_data`
+
+    A single model predicts day by day, each day's prediction becomes the next
+    day's lagged data. A dict of direct models predicts every day at once from
+    the lags known for the first day."""
+    feature_columns, feature_names = model_columns(batch_data, feature_names)
+    if isinstance(model, dict):
+        return forecast.direct_forecast(
+            model,
+            batch_data,
+            feature_columns,
+            forecast_on=forecast_on,
+            lag_columns=forecast.LAG_COLUMNS,
+            feature_names=feature_names,
+        )
+    return forecast.recursive_forecast(
+        model,
+        batch_data,
+        feature_columns,
+        lag_columns=forecast.LAG_COLUMNS,
+        feature_names=feature_names,
+    )
+
+
+def forecast_places(
+    project, model, feature_names, forecast_on, ids: list[str] | None = None
+) -> pd.DataFrame:
+    """Forecasts made on `forecast_on` for the sensors in `ids`, or all sensors
+
+    Returns:
+        pd.DataFrame with columns [date, id, predicted_pm25, forecast_on], as
+        the air_quality_forecasts feature group"""
+    weather_fg, lagged_aq_fg = project.get_feature_groups(
+        [("weather", 2), ("air_quality_lagged", 3)]
+    )
+    start_date = (pd.Timestamp(forecast_on) + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+    batch_data = read_batch_data(weather_fg, lagged_aq_fg, start_date, ids)
+    batch_data["predicted_pm25"] = predict(
+        model, batch_data, feature_names, forecast_on
+    )
+    # Direct models leave the days beyond their last horizon without a forecast
+    batch_data = batch_data.dropna(subset=["predicted_pm25"])
+    batch_data = batch_data[["date", "id", "predicted_pm25"]]
+    batch_data["forecast_on"] = pd.Timestamp(forecast_on)
+    return schema.coerce(batch_data)
+
+
+def shard_ids(ids: list[str], n_shards: int) -> list[list[str]]:
+    """Partition sensor ids into `n_shards` shards
+
+    Ids are assigned by a hash of the id, so a sensor stays in the same shard
+    in every job and when other sensors are added or removed."""
+    shards = [[] for _ in range(n_shards)]
+    for sensor_id in ids:
+        shards[zlib.crc32(str(sensor_id).encode()) % n_shards].append(sensor_id)
+    return shards
+
+
+# Project and model of a shard worker, loaded once per worker
+_worker = None
+
+
+def _init_worker(project_name, version, direct_version):
+    global _worker
+    project = hops.Project(name=project_name)
+    model, feature_names = load_model(project.model_registry, version, direct_version)
+    # Shards run in parallel processes, not threads
+    for regressor in model.values() if isinstance(model, dict) else [model]:
+        regressor.set_params(n_jobs=1)
+    _worker = (project, model, feature_names)
+
+
+def _forecast_shard(ids: list[str], forecast_on) -> pd.DataFrame:
+    project, model, feature_names = _worker
+    return forecast_places(project, model, feature_names, forecast_on, ids)
+
+
+def forecast_shards(
+    project_name: str,
+    shards: list[list[str]],
+    forecast_on,
+    version: int = MODEL_VERSION,
+    direct_version=None,
+    max_workers: int | None = None,
+) -> pd.DataFrame:
+    """Forecasts of every shard of sensors, each read and predicted in a worker
+    process that logs in and loads the model once
+
+    Returns:
+        pd.DataFrame with the forecasts of all shards, see `forecast_places`"""
+    shards = [shard for shard in shards if shard]
+    with process_pool(
+        max_workers or len(shards),
+        initializer=_init_worker,
+        initargs=(project_name, version, direct_version),
+    ) as executor:
+        forecasts = list(
+            executor.map(_forecast_shard, shards, [forecast_on] * len(shards))
+        )
+    return pd.concat(forecasts, ignore_index=True)
@@ -0,0 +1,116 @@
+import io
+import logging
+from pathlib import Path
+
+import pandas as pd
+
+import schema
+from helper import process_pool
+
+logger = logging.getLogger(__name__)
+
+
+def process_aq(df: pd.DataFrame, place: dict[str, dict]) -> None:
+    """
+    Process air quality dataframe depending on the type (A or @).
+
+    The parameter will be modified in place to:
+        pd.DataFrame: Processed dataframe with columns [id, date, pm25]
+    """
+    if place["id"].startswith("@"):
+        pass
+    elif place["id"].startswith("A"):
+        df.rename(columns={"median": "pm25"}, inplace=True)
+    else:
+        raise ValueError(f"Unknown place id format: {place['id']}")
+    df["pm25"] = df["pm25"].astype("float32")
+    df.drop(df.columns.difference(["date", "pm25"]), axis=1, inplace=True)
+    df.dropna(inplace=True)
+    df["id"] = place["id"]
+
+
+def read_aq_csv(file_path: Path) -> pd.DataFrame:
+    """Read an air quality CSV downloaded from AQICN
+
+    Uses the pyarrow CSV engine, unless the file has comments, which only the
+    default engine supports."""
+    data = file_path.read_bytes()
+    if b"#" in data:
+        return pd.read_csv(
+            io.BytesIO(data), comment="#", skipinitialspace=True, parse_dates=["date"]
+        )
+    df = pd.read_csv(io.BytesIO(data), engine="pyarrow")
+    # The pyarrow engine has no skipinitialspace, values padded with spaces
+    # are read as strings
+    df.columns = df.columns.str.strip()
+    for col in df.columns.drop("date"):
+        if df[col].dtype == object:
+            df[col] = pd.to_numeric(df[col].str.strip(), errors="coerce")
+    df["date"] = pd.to_datetime(df["date"])
+    return df
+
+
+def _cache_path(file_path: Path, cache_dir: Path) -> Path:
+    """Parquet copy of a CSV, named after the CSV's modification time and size"""
+    stat = file_path.stat()
+    return cache_dir / f"{file_path.stem}-{stat.st_mtime_ns}-{stat.st_size}.parquet"
+
+
+def _convert(file_path: Path, place: dict, cache_dir: Path) -> pd.DataFrame:
+    """Read and process a CSV, and save it as Parquet"""
+    df = read_aq_csv(file_path)
+    process_aq(df, place)
+    for stale in cache_dir.glob(f"{file_path.stem}-*.parquet"):
+        stale.unlink()
+    df.to_parquet(_cache_path(file_path, cache_dir), index=False)
+    return df
+
+
+def read_aq_csvs(
+    places: dict[str, dict],
+    csv_dir: str = "data/air-quality",
+    cache_dir: str = "data/air-quality/parquet",
+    max_workers: int | None = None,
+) -> pd.DataFrame:
+    """Read the air quality CSVs of all places into a single DataFrame
+
+    Each processed CSV is kept as Parquet, keyed by the CSV's modification time
+    and size. Only new or changed CSVs are parsed, in parallel processes.
+
+    Arguments:
+        places: dict of place id to place data, CSVs are named `<id>.csv`
+        csv_dir: directory of the CSVs
+        cache_dir: directory of the Parquet copies
+        max_workers: number of parsing processes, defaults to the number of CPUs
+
+    Returns:
+        pd.DataFrame with columns [date, pm25, id], see `schema.coerce`"""
+    csv_dir, cache_dir = Path(csv_dir), Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    file_paths = {}
+    for place_id in places:
+        file_path = csv_dir / f"{place_id}.csv"
+        if not file_path.is_file():
+            raise FileNotFoundError(f"File {file_path} not found")
+        file_paths[place_id] = file_path
+
+    dfs = {
+        place_id: pd.read_parquet(_cache_path(file_path, cache_dir))
+        for place_id, file_path in file_paths.items()
+        if _cache_path(file_path, cache_dir).is_file()
+    }
+    to_parse = [place_id for place_id in places if place_id not in dfs]
+    logger.info("Parsing %d of %d air quality CSVs", len(to_parse), len(places))
+    if to_parse:
+        with process_pool(max_workers) as executor:
+            parsed = executor.map(
+                _convert,
+                [file_paths[place_id] for place_id in to_parse],
+                [places[place_id] for place_id in to_parse],
+                [cache_dir] * len(to_parse),
+            )
+            dfs.update(zip(to_parse, parsed))
+
+    return schema.coerce(
+        pd.concat([dfs[place_id] for place_id in places], ignore_index=True), places
+    )
@@ -0,0 +1,494 @@
+"""Local stand-in for the parts of the Hopsworks API used by the pipelines
+
+Feature groups are stored as Parquet, partitioned by feature group, version
+and event date, e.g. `<root>/feature_groups/air_quality_2/date=2025-01-01/`.
+Feature views and models are stored next to them as JSON definitions and
+directories, so whole pipelines can run offline with `hops.Project(...,
+backend="local")`.
+"""
+
+import datetime
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+PARTITION_PREFIX = "date="
+
+
+def _as_datetime(values):
+    """Convert dates, timestamps or date strings to naive UTC datetimes"""
+    if isinstance(values, pd.Series):
+        return pd.to_datetime(values, utc=True).dt.tz_localize(None)
+    return pd.to_datetime(values, utc=True).tz_localize(None)
+
+
+def _is_date_like(column: pd.Series, value) -> bool:
+    """Whether a column or the value compared with it holds dates or timestamps"""
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return True
+    if isinstance(value, datetime.date):
+        return True
+    first = column.dropna()[:1]
+    return len(first) > 0 and isinstance(first.iloc[0], datetime.date)
+
+
+class Feature:
+    """A feature of a feature group, comparing it gives a Filter"""
+
+    def __init__(self, name: str, feature_group: "FeatureGroup"):
+        self.name = name
+        self.feature_group = feature_group
+
+    def _filter(self, op: str, value) -> "Filter":
+        return Filter(self, op, value)
+
+    def __eq__(self, value):
+        return self._filter("==", value)
+
+    def __ne__(self, value):
+        return self._filter("!=", value)
+
+    def __lt__(self, value):
+        return self._filter("<", value)
+
+    def __le__(self, value):
+        return self._filter("<=", value)
+
+    def __gt__(self, value):
+        return self._filter(">", value)
+
+    def __ge__(self, value):
+        return self._filter(">=", value)
+
+    def isin(self, values):
+        return self._filter("isin", list(values))
+
+    __hash__ = None
+
+
+class Filter:
+    """Comparison of a feature with a value, combine them with & and |"""
+
+    def __init__(self, feature: Feature, op: str, value):
+        self.feature = feature
+        self.op = op
+        self.value = value
+
+    def __and__(self, other: "Filter") -> "Logic":
+        return Logic("&", self, other)
+
+    def __or__(self, other: "Filter") -> "Logic":
+        return Logic("|", self, other)
+
+    def mask(self, df: pd.DataFrame) -> pd.Series:
+        """Rows of `df` that pass the filter"""
+        column, value = df[self.feature.name], self.value
+        # Dates are stored as dates or timestamps and compared with date
+        # strings, in the event time as in any other feature
+        if self.op != "isin" and (
+            self.feature.name == self.feature.feature_group.event_time
+            or _is_date_like(column, value)
+        ):
+            column, value = _as_datetime(column), _as_datetime(value)
+        return {
+            "==": column.__eq__,
+            "!=": column.__ne__,
+            "<": column.__lt__,
+            "<=": column.__le__,
+            ">": column.__gt__,
+            ">=": column.__ge__,
+            "isin": column.isin,
+        }[self.op](value)
+
+    def date_bounds(self, event_time: str) -> tuple:
+        """Inclusive (first, last) event dates that can pass the filter,
+        None when unbounded"""
+        if self.feature.name != event_time or self.op in ("!=", "isin"):
+            return None, None
+        day = _as_datetime(self.value).normalize()
+        first = day if self.op in ("==", ">", ">=") else None
+        last = day if self.op in ("==", "<", "<=") else None
+        return first, last
+
+
+class Logic(Filter):
+    """Filters combined with & or |"""
+
+    def __init__(self, op: str, left: Filter, right: Filter):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def mask(self, df: pd.DataFrame) -> pd.Series:
+        if self.op == "&":
+            return self.left.mask(df) & self.right.mask(df)
+        return self.left.mask(df) | self.right.mask(df)
+
+    def date_bounds(self, event_time: str) -> tuple:
+        (left_first, left_last), (right_first, right_last) = (
+            self.left.date_bounds(event_time),
+            self.right.date_bounds(event_time),
+        )
+        if self.op == "&":
+            firsts = [day for day in (left_first, right_first) if day is not None]
+            lasts = [day for day in (left_last, right_last) if day is not None]
+            return max(firsts, default=None), min(lasts, default=None)
+        if None in (left_first, right_first):
+            first = None
+        else:
+            first = min(left_first, right_first)
+        if None in (left_last, right_last):
+            last = None
+        else:
+            last = max(left_last, right_last)
+        return first, last
+
+
+class FeatureGroup:
+    def __init__(self, feature_store: "FeatureStore", name: str, version: int):
+        self.feature_store = feature_store
+        self.name = name
+        self.version = version
+        self.path = feature_store.root / "feature_groups" / f"{name}_{version}"
+        self._metadata = json.loads((self.path / "_metadata.json").read_text())
+
+    @property
+    def primary_key(self) -> list[str]:
+        return self._metadata["primary_key"]
+
+    @property
+    def event_time(self) -> str:
+        return self._metadata["event_time"]
+
+    @property
+    def features(self) -> list[str]:
+        return list(self._metadata["features"])
+
+    def __getattr__(self, name: str) -> Feature:
+        if not name.startswith("_") and name in self._metadata["features"]:
+            return Feature(name, self)
+        raise AttributeError(name)
+
+    def _save_metadata(self) -> None:
+        (self.path / "_metadata.json").write_text(json.dumps(self._metadata, indent=2))
+
+    def _partition(self, day: pd.Timestamp) -> Path:
+        return self.path / f"{PARTITION_PREFIX}{day.strftime('%Y-%m-%d')}"
+
+    def _partitions(self, first=None, last=None) -> list[Path]:
+        """Partition directories with dates between first and last (inclusive)"""
+        partitions = []
+        for partition in sorted(self.path.glob(f"{PARTITION_PREFIX}*")):
+            day = pd.Timestamp(partition.name.removeprefix(PARTITION_PREFIX))
+            if (first is None or day >= first) and (last is None or day <= last):
+                partitions.append(partition)
+        return partitions
+
+    def insert(self, df: pd.DataFrame, wait: bool = False, **kwargs) -> tuple:
+        """Upsert rows on primary key and event time, like the offline store"""
+        for col in df.columns:
+            self._metadata["features"].setdefault(col, "")
+        self._save_metadata()
+        key = [*self.primary_key, self.event_time]
+        days = _as_datetime(df[self.event_time]).dt.normalize()
+        for day, rows in df.groupby(days, sort=False):
+            partition = self._partition(day)
+            partition.mkdir(parents=True, exist_ok=True)
+            part = partition / "data.parquet"
+            if part.is_file():
+                rows = pd.concat([pd.read_parquet(part), rows], ignore_index=True)
+            rows = rows.drop_duplicates(key, keep="last")
+            tmp_part = part.with_suffix(".tmp")
+            rows.to_parquet(tmp_part, index=False)
+            os.replace(tmp_part, part)
+        return None, None
+
+    def update_feature_description(
+        self, name: str, description: str
+    ) -> "FeatureGroup":
+        self._metadata["features"][name] = description
+        self._save_metadata()
+        return self
+
+    def _read(self, columns: list[str] | None = None, filter: Filter | None = None):
+        """Read rows, only opening partitions that can pass the filter"""
+        first, last = None, None
+        if filter is not None:
+            first, last = filter.date_bounds(self.event_time)
+        partitions = self._partitions(first, last)
+        read_columns = columns
+        if columns is not None and filter is not None:
+            # Filter columns are needed to evaluate it, even if not selected
+            read_columns = list(dict.fromkeys([*columns, *self.features]))
+        if not partitions:
+            return pd.DataFrame(columns=columns or self.features)
+        df = pd.concat(
+            [
+                pd.read_parquet(partition / "data.parquet", columns=read_columns)
+                for partition in partitions
+            ],
+            ignore_index=True,
+        )
+        if filter is not None:
+            df = df[filter.mask(df)].reset_index(drop=True)
+        return df if columns is None else df[columns]
+
+    def read(self, **kwargs) -> pd.DataFrame:
+        return self._read()
+
+    def filter(self, filter: Filter) -> "Query":
+        return Query(self, None, filter=filter)
+
+    def select(self, features: list[str]) -> "Query":
+        return Query(self, list(features))
+
+    def select_all(self) -> "Query":
+        return Query(self, None)
+
+
+class Query:
+    """Features selected from a feature group, optionally joined with others
+
+    Joins match each row with the latest row of the other feature group with
+    the same key and an event time at or before its own (as of join)."""
+
+    def __init__(
+        self, feature_group: FeatureGroup, features: list[str] | None, filter=None
+    ):
+        self.feature_group = feature_group
+        self.features = features
+        self._filter = filter
+        self.joins = []
+
+    def join(
+        self, query: "Query", on: str | list[str], prefix: str = ""
+    ) -> "Query":
+        on = [on] if isinstance(on, str) else list(on)
+        self.joins.append((query, on, prefix))
+        return self
+
+    def filter(self, filter: Filter) -> "Query":
+        self._filter = filter if self._filter is None else self._filter & filter
+        return self
+
+    def read(self, **kwargs) -> pd.DataFrame:
+        fg = self.feature_group
+        df = fg._read(self.features, self._filter)
+        for query, on, prefix in self.joins:
+            right = query.read()
+            right_fg = query.feature_group
+            right = right.rename(columns={col: prefix + col for col in right.columns})
+            right_key = [prefix + col for col in on]
+            right_time = prefix + right_fg.event_time
+            left_ts = _as_datetime(df[fg.event_time])
+            right_ts = _as_datetime(right[right_time])
+            df = pd.merge_asof(
+                df.assign(_event_ts=left_ts).sort_values("_event_ts"),
+                right.assign(_event_ts=right_ts)
+                .dropna(subset=["_event_ts"])
+                .sort_values("_event_ts"),
+                on="_event_ts",
+                left_by=on,
+                right_by=right_key,
+                direction="backward",
+            )
+            df = df.dropna(subset=[right_time]).drop(columns="_event_ts")
+        return df.reset_index(drop=True)
+
+    def to_dict(self) -> dict:
+        return {
+            "feature_group": [self.feature_group.name, self.feature_group.version],
+            "features": self.features,
+            "joins": [
+                {"query": query.to_dict(), "on": on, "prefix": prefix}
+                for query, on, prefix in self.joins
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, feature_store: "FeatureStore", definition: dict) -> "Query":
+        name, version = definition["feature_group"]
+        feature_group = feature_store.get_feature_group(name, version)
+        query = cls(feature_group, definition["features"])
+        for join in definition["joins"]:
+            query.join(
+                cls.from_dict(feature_store, join["query"]), join["on"], join["prefix"]
+            )
+        return query
+
+
+class FeatureView:
+    """Definition of a feature view, for the model registry. The pipelines read
+    training data with `training.read_training_data` on both backends"""
+
+    def __init__(self, feature_store: "FeatureStore", definition: dict):
+        self.feature_store = feature_store
+        self._definition = definition
+        self.name = definition["name"]
+        self.version = definition["version"]
+        self.query = Query.from_dict(feature_store, definition["query"])
+
+
+class FeatureStore:
+    def __init__(self, root: Path, project_name: str):
+        self.root = root
+        self.project_name = project_name
+
+    def get_feature_group(self, name: str, version: int) -> FeatureGroup:
+        return FeatureGroup(self, name, version)
+
+    def get_or_create_feature_group(
+        self,
+        name: str,
+        version: int,
+        primary_key: list[str],
+        event_time: str,
+        description: str = "",
+        **kwargs,
+    ) -> FeatureGroup:
+        path = self.root / "feature_groups" / f"{name}_{version}"
+        if not (path / "_metadata.json").is_file():
+            path.mkdir(parents=True, exist_ok=True)
+            metadata = {
+                "description": description,
+                "primary_key": list(primary_key),
+                "event_time": event_time,
+                "features": {},
+            }
+            (path / "_metadata.json").write_text(json.dumps(metadata, indent=2))
+        return FeatureGroup(self, name, version)
+
+    def _feature_view_path(self, name: str, version: int) -> Path:
+        return self.root / "feature_views" / f"{name}_{version}.json"
+
+    def get_feature_view(self, name: str, version: int) -> FeatureView:
+        definition = json.loads(self._feature_view_path(name, version).read_text())
+        return FeatureView(self, definition)
+
+    def get_or_create_feature_view(
+        self,
+        name: str,
+        version: int,
+        query: Query,
+        description: str = "",
+        labels: list[str] | None = None,
+        inference_helper_columns: list[str] | None = None,
+        training_helper_columns: list[str] | None = None,
+        **kwargs,
+    ) -> FeatureView:
+        path = self._feature_view_path(name, version)
+        if not path.is_file():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            definition = {
+                "name": name,
+                "version": version,
+                "description": description,
+                "labels": labels or [],
+                "inference_helper_columns": inference_helper_columns or [],
+                "training_helper_columns": training_helper_columns or [],
+                "query": query.to_dict(),
+            }
+            path.write_text(json.dumps(definition, indent=2))
+        return self.get_feature_view(name, version)
+
+
+class Model:
+    def __init__(self, registry: "ModelRegistry", metadata: dict):
+        self.registry = registry
+        self._metadata = metadata
+        self.name = metadata["name"]
+        self.version = metadata.get("version")
+        self.training_metrics = metadata["metrics"]
+        self.description = metadata["description"]
+
+    @property
+    def path(self) -> Path:
+        return self.registry.root / self.name / str(self.version)
+
+    @property
+    def created(self) -> int:
+        """Newest modification time of the artifacts, which changes whenever
+        they are replaced, in place of the registration time of Hopsworks"""
+        return max(
+            (path.stat().st_mtime_ns for path in (self.path / "artifacts").rglob("*")),
+            default=0,
+        )
+
+    def save(self, model_path: str) -> "Model":
+        """Register the model file or directory as the next version"""
+        self.version = self.registry._next_version(self.name)
+        self._metadata["version"] = self.version
+        artifacts = self.path / "artifacts"
+        if Path(model_path).is_dir():
+            shutil.copytree(model_path, artifacts)
+        else:
+            artifacts.mkdir(parents=True)
+            shutil.copy2(model_path, artifacts)
+        (self.path / "_metadata.json").write_text(json.dumps(self._metadata, indent=2))
+        return self
+
+    def download(self) -> str:
+        return str(self.path / "artifacts")
+
+    def get_feature_view(self, **kwargs) -> FeatureView:
+        name, version = self._metadata["feature_view"]
+        return self.registry.feature_store.get_feature_view(name, version)
+
+
+class ModelRegistry:
+    def __init__(self, feature_store: FeatureStore):
+        self.feature_store = feature_store
+        self.root = feature_store.root / "models"
+        # Model frameworks share one implementation, as in mr.python
+        self.python = self
+        self.sklearn = self
+
+    def _next_version(self, name: str) -> int:
+        versions = [int(path.name) for path in (self.root / name).glob("[0-9]*")]
+        return max(versions, default=0) + 1
+
+    def create_model(
+        self,
+        name: str,
+        metrics: dict | None = None,
+        feature_view: FeatureView | None = None,
+        description: str = "",
+        **kwargs,
+    ) -> Model:
+        metadata = {
+            "name": name,
+            "metrics": metrics or {},
+            "description": description,
+            "feature_view": None
+            if feature_view is None
+            else [feature_view.name, feature_view.version],
+        }
+        return Model(self, metadata)
+
+    def get_models(self, name: str) -> list[Model]:
+        return [
+            self.get_model(name, int(path.name))
+            for path in sorted((self.root / name).glob("[0-9]*"))
+        ]
+
+    def get_model(self, name: str, version: int) -> Model:
+        metadata_path = self.root / name / str(version) / "_metadata.json"
+        return Model(self, json.loads(metadata_path.read_text()))
+
+
+class Project:
+    """Local counterpart of a logged in hopsworks project"""
+
+    def __init__(self, name: str, root: str):
+        self.name = name
+        self.feature_store = FeatureStore(Path(root), name)
+        self.model_registry = ModelRegistry(self.feature_store)
+
+    def get_feature_store(self) -> FeatureStore:
+        return self.feature_store
+
+    def get_model_registry(self) -> ModelRegistry:
+        return self.model_registry
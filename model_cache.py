@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+from xgboost import XGBRegressor
+
+CACHE_DIR = ".model-cache"
+MAX_CACHE_BYTES = 512 * 1024**2
+# Partial entries older than this are left over from interrupted writes
+STALE_TMP_SECONDS = 3600
+
+# Models already loaded by this process, by (name, version, checksum)
+_loaded = {}
+
+
+def _checksum(paths: list[Path]) -> str:
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _model_files(entry: Path, meta: dict) -> dict:
+    """Cached booster files, by horizon for a bundle of direct models"""
+    if meta.get("horizons") is None:
+        return {None: entry / "model.ubj"}
+    return {horizon: entry / f"h{horizon}.ubj" for horizon in meta["horizons"]}
+
+
+def _entries(cache_dir: Path) -> list[tuple[Path, dict]]:
+    """Cached models with their metadata, without partial entries"""
+    return [
+        (meta_path.parent, json.loads(meta_path.read_text()))
+        for meta_path in cache_dir.glob("*/*/meta.json")
+        if meta_path.parent.suffix != ".tmp"
+    ]
+
+
+def _evict(cache_dir: Path, max_bytes: int) -> None:
+    """Remove partial entries of interrupted writes, and least recently used
+    models until the cache fits in `max_bytes`"""
+    for tmp_entry in cache_dir.glob("*/*.tmp"):
+        if time.time() - tmp_entry.stat().st_mtime > STALE_TMP_SECONDS:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+    entries = sorted(_entries(cache_dir), key=lambda entry: entry[1]["last_used"])
+    total = sum(meta["size"] for _path, meta in entries)
+    for path, meta in entries[:-1]:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= meta["size"]
+
+
+def _read_meta(entry: Path) -> dict | None:
+    """Metadata of a cached model, or None if it is missing or corrupt"""
+    meta_path = entry / "meta.json"
+    if not meta_path.is_file():
+        return None
+    meta = json.loads(meta_path.read_text())
+    files = list(_model_files(entry, meta).values())
+    if not all(path.is_file() for path in files):
+        return None
+    if meta.get("checksum") != _checksum(files):
+        return None
+    return meta
+
+
+def _store(model_dir: str, entry: Path, meta: dict) -> None:
+    """Store a downloaded model, or bundle of direct models saved by
+    `training.save_direct_models`, as binary (UBJSON) boosters"""
+    bundle_path = Path(model_dir) / "bundle.json"
+    horizons = None
+    if bundle_path.is_file():
+        horizons = json.loads(bundle_path.read_text())["horizons"]
+    meta = {**meta, "horizons": horizons}
+    # Unique per writer, so concurrent processes never share a partial entry
+    tmp_entry = entry.with_name(f"{entry.name}.{uuid.uuid4().hex}.tmp")
+    tmp_entry.mkdir(parents=True)
+    files = _model_files(tmp_entry, meta)
+    for horizon, path in files.items():
+        model = XGBRegressor()
+        model.load_model(f"{model_dir}/{path.stem}.json")
+        model.save_model(path)
+    feature_names = model.get_booster().feature_names or []
+    (tmp_entry / "feature_names.json").write_text(json.dumps(feature_names))
+    meta = {
+        **meta,
+        "checksum": _checksum(list(files.values())),
+        "size": sum(path.stat().st_size for path in files.values()),
+        "last_used": time.time(),
+    }
+    (tmp_entry / "meta.json").write_text(json.dumps(meta))
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp_entry, entry)
+
+
+def get_model(
+    model_registry,
+    name: str,
+    version: int,
+    cache_dir: str = CACHE_DIR,
+    max_bytes: int = MAX_CACHE_BYTES,
+) -> tuple[XGBRegressor | dict[int, XGBRegressor], list[str]]:
+    """Load a registered XGBoost model, or bundle of direct models, through a
+    local cache
+
+    Models are downloaded once and kept as binary boosters, with their feature
+    names next to them, keyed by name and version. A cached model is used
+    without downloading it if the registry reports the same creation time for
+    its version as when it was cached. Without a creation time the model is
+    downloaded, and the cached booster is only reused if the checksum of the
+    downloaded artifact is unchanged. The least recently used models are
+    evicted when the cache grows beyond `max_bytes`.
+
+    Returns:
+        the model, or dict of horizon to model for a bundle, and the names of
+        its features, in the order it expects them
+    """
+    registry_model = model_registry.get_model(name=name, version=version)
+    created = getattr(registry_model, "created", None)
+    created = None if created is None else str(created)
+    entry = Path(cache_dir) / name / str(version)
+    meta = _read_meta(entry)
+    if meta is None or created is None or meta.get("created") != created:
+        model_dir = registry_model.download()
+        artifact_checksum = _checksum(sorted(Path(model_dir).glob("*.json")))
+        if meta is None or meta.get("artifact_checksum") != artifact_checksum:
+            _store(
+                model_dir,
+                entry,
+                {
+                    "version": version,
+                    "created": created,
+                    "artifact_checksum": artifact_checksum,
+                },
+            )
+            _evict(Path(cache_dir), max_bytes)
+            meta = _read_meta(entry)
+        meta["created"] = created
+    meta["last_used"] = time.time()
+    (entry / "meta.json").write_text(json.dumps(meta))
+
+    key = (name, version, meta["checksum"])
+    if key not in _loaded:
+        models = {}
+        for horizon, path in _model_files(entry, meta).items():
+            models[horizon] = XGBRegressor()
+            models[horizon].load_model(path)
+        feature_names = json.loads((entry / "feature_names.json").read_text())
+        model = models if meta.get("horizons") is not None else models[None]
+        _loaded[key] = (model, feature_names)
+    return _loaded[key]
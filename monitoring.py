@@ -0,0 +1,186 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import schema
+
+# Feature group of forecast accuracy per sensor, lead time and day
+METRICS_FG = ("forecast_accuracy", 1)
+# Days of the rolling windows errors are averaged over
+WINDOW_DAYS = (7, 30)
+# Forecasts are at most this many days ahead of the day they were made on
+MAX_LEAD_DAYS = 14
+# How far back the watermark is looked for in the metrics
+WATERMARK_LOOKBACK_DAYS = 90
+# Daily error sums, the rolling metrics are computed from
+SUM_COLUMNS = ["n", "abs_error_sum", "squared_error_sum", "error_sum"]
+KEY = ["id", "lead_days"]
+
+
+def metrics_feature_group(feature_store):
+    name, version = METRICS_FG
+    return feature_store.get_or_create_feature_group(
+        name=name,
+        description="Rolling forecast errors per sensor and lead time",
+        version=version,
+        primary_key=["id", "lead_days", "date"],
+        event_time="date",
+    )
+
+
+def _no_metrics() -> pd.DataFrame:
+    return pd.DataFrame(columns=["id", "lead_days", "date", *SUM_COLUMNS])
+
+
+def read_recent_metrics(metrics_fg, today: datetime.date) -> pd.DataFrame:
+    """Metrics of the last WATERMARK_LOOKBACK_DAYS days, with dates as days"""
+    # A group created by the first run has no features to filter on yet
+    if not metrics_fg.features:
+        return _no_metrics()
+    since = today - datetime.timedelta(days=WATERMARK_LOOKBACK_DAYS)
+    metrics = metrics_fg.filter(metrics_fg.date >= since.strftime("%Y-%m-%d")).read()
+    if metrics.empty:
+        return _no_metrics()
+    return schema.coerce(metrics)
+
+
+def daily_errors(aq_df: pd.DataFrame, forecast_df: pd.DataFrame) -> pd.DataFrame:
+    """Error sums of the forecasts of each sensor, lead time and day
+
+    Every forecast of a day is matched with the actual reading of its sensor
+    on that day, its lead time is the days between the forecast and the day.
+
+    Returns:
+        pd.DataFrame with columns [id, lead_days, date, n, abs_error_sum,
+        squared_error_sum, error_sum]"""
+    actuals = schema.coerce(aq_df[["id", "date", "pm25"]])
+    actuals = actuals.drop_duplicates(["id", "date"], keep="last")
+    forecasts = schema.coerce(
+        forecast_df[["id", "date", "predicted_pm25", "forecast_on"]]
+    )
+    scored = forecasts.merge(actuals, on=["id", "date"], how="inner")
+    scored = scored.dropna(subset=["pm25", "predicted_pm25"])
+    error = scored["predicted_pm25"].astype("float64") - scored["pm25"]
+    scored = scored.assign(
+        lead_days=(scored["date"] - scored["forecast_on"]).dt.days.astype("int16"),
+        n=1,
+        abs_error_sum=error.abs(),
+        squared_error_sum=error**2,
+        error_sum=error,
+    )
+    return (
+        scored.groupby([*KEY, "date"], observed=True)[SUM_COLUMNS]
+        .sum()
+        .reset_index()
+        .astype({"n": "int32"})
+    )
+
+
+def rolling_metrics(
+    daily: pd.DataFrame, first_day: pd.Timestamp, windows=WINDOW_DAYS
+) -> pd.DataFrame:
+    """Rolling MAE, RMSE and bias of each sensor and lead time, for the days
+    from `first_day` on
+
+    The daily sums are laid out as a dense (sensor and lead time x day x sum)
+    array, so every window is a difference of cumulative sums over the day axis.
+    `daily` needs the days of the longest window before `first_day`.
+
+    Returns:
+        pd.DataFrame with the daily sums and [mae_{w}d, rmse_{w}d, bias_{w}d]
+        for every window w, one row per sensor, lead time and day from
+        `first_day` with forecasts in its longest window"""
+    if daily.empty:
+        return daily.iloc[:0]
+    groups = daily[KEY].drop_duplicates().reset_index(drop=True)
+    group_idx = daily[KEY].merge(groups.reset_index(), on=KEY, how="left")["index"]
+    days = pd.date_range(daily["date"].min(), daily["date"].max(), freq="D")
+    day_idx = ((daily["date"] - days[0]).dt.days).to_numpy()
+
+    sums = np.zeros((len(groups), len(days) + 1, len(SUM_COLUMNS)))
+    sums[group_idx.to_numpy(), day_idx + 1] = daily[SUM_COLUMNS].to_numpy("float64")
+    cumulative = sums.cumsum(axis=1)
+
+    out_days = np.flatnonzero(days >= first_day)
+
+    def window_sums(window):
+        start = np.maximum(out_days + 1 - window, 0)
+        return np.moveaxis(cumulative[:, out_days + 1] - cumulative[:, start], -1, 0)
+
+    columns = {}
+    for window in windows:
+        n, abs_error, squared_error, error = window_sums(window)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            columns[f"mae_{window}d"] = abs_error / n
+            columns[f"rmse_{window}d"] = np.sqrt(squared_error / n)
+            columns[f"bias_{window}d"] = error / n
+
+    rows = np.nonzero(window_sums(max(windows))[0] > 0)
+    metrics = groups.iloc[rows[0]].reset_index(drop=True)
+    metrics["date"] = days[out_days[rows[1]]]
+    for col_idx, col in enumerate(SUM_COLUMNS):
+        metrics[col] = sums[:, out_days + 1, col_idx][rows]
+    for col, values in columns.items():
+        metrics[col] = values[rows].astype("float32")
+    return metrics.astype({"n": "int32", "lead_days": "int16"})
+
+
+def score_new_days(
+    air_quality_fg, forecast_fg, metrics_fg, today: datetime.date | None = None
+) -> pd.DataFrame:
+    """Score the forecasts of days with readings after the watermark, the
+    latest day in the metrics, and insert their metrics
+
+    Only readings after the watermark, forecasts that can be about them and
+    the metrics of the longest window before them are read, so each run costs
+    as much as the days it scores.
+
+    Returns:
+        pd.DataFrame of the inserted metrics"""
+    today = today or datetime.date.today()
+    recent = read_recent_metrics(metrics_fg, today)
+    watermark = recent["date"].max() if not recent.empty else None
+
+    if watermark is None:
+        aq_df = air_quality_fg.read()
+        forecast_df = forecast_fg.read()
+    else:
+        after = (watermark + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+        aq_df = air_quality_fg.filter(air_quality_fg.date >= after).read()
+        forecast_df = forecast_fg.filter(
+            (forecast_fg.date >= after)
+            & (
+                forecast_fg.forecast_on
+                >= (watermark - pd.Timedelta(days=MAX_LEAD_DAYS)).strftime("%Y-%m-%d")
+            )
+        ).read()
+    new_daily = daily_errors(aq_df, forecast_df)
+    new_daily = new_daily[new_daily["date"] <= pd.Timestamp(today)]
+    if new_daily.empty:
+        return new_daily
+
+    first_day = new_daily["date"].min()
+    history_start = first_day - pd.Timedelta(days=max(WINDOW_DAYS) - 1)
+    history = recent[
+        (recent["date"] >= history_start) & (recent["date"] < first_day)
+    ][["id", "lead_days", "date", *SUM_COLUMNS]]
+    metrics = rolling_metrics(
+        pd.concat([history, new_daily], ignore_index=True).astype(
+            {"lead_days": "int16"}
+        ),
+        first_day,
+    )
+    metrics = schema.coerce(metrics)
+    metrics_fg.insert(schema.to_storage(schema.validate(metrics)))
+    return metrics
+
+
+def read_accuracy(metrics_fg, days: int = 30, today: datetime.date | None = None):
+    """Metrics of the last `days` days, for the dashboard"""
+    if not metrics_fg.features:
+        return schema.coerce(_no_metrics())
+    today = today or datetime.date.today()
+    since = (today - datetime.timedelta(days=days)).strftime("%Y-%m-%d")
+    accuracy = metrics_fg.filter(metrics_fg.date >= since).read()
+    return schema.coerce(accuracy)
@@ -0,0 +1,27 @@
+# %%
+# Score the forecasts of days with new air quality readings, and keep rolling
+# errors per sensor and lead time in a feature group
+import hops
+import monitoring
+import pandas as pd
+import snapshot
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# %%
+project = hops.Project(name="ostergotland_air_quality")
+air_quality_fg, forecasts_fg = project.get_feature_groups(
+    [("air_quality", 2), ("air_quality_forecasts", 3)]
+)
+metrics_fg = monitoring.metrics_feature_group(project.feature_store)
+metrics = monitoring.score_new_days(air_quality_fg, forecasts_fg, metrics_fg)
+print(f"Scored {metrics['date'].nunique()} new days")
+metrics.head()
+
+# %%
+# Accuracy of the last days for the dashboard, including the metrics just inserted
+accuracy = pd.concat(
+    [monitoring.read_accuracy(metrics_fg), metrics], ignore_index=True
+).drop_duplicates(["id", "lead_days", "date"], keep="last")
+snapshot.write(accuracy, snapshot.ACCURACY_FILE)
@@ -1,14 +1,21 @@
+import os
+
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.patches import Patch
-from matplotlib.ticker import MultipleLocator
+from matplotlib.ticker import MultipleLocator, ScalarFormatter
 
+from helper import process_pool
 
-def plot_air_quality_forecast(df: pd.DataFrame, place, file_path: str, hindcast=False):
-    _fig, ax = plt.subplots(figsize=(10, 6))
+FIGURE_SIZE = (10, 6)
+# Places rendered in one process before a process pool is worth starting
+MIN_PLACES_PER_WORKER = 20
 
-    place_df = df[df["id"] == place["id"]]
 
+def _draw(ax, place_df: pd.DataFrame, place, hindcast=False) -> None:
+    """Draw the forecast, and actual values of a hindcast, of one place on `ax`"""
     day = pd.to_datetime(place_df["date"]).dt.date
     # Plot each column separately in matplotlib
     ax.plot(
@@ -25,7 +32,7 @@ def plot_air_quality_forecast(df: pd.DataFrame, place, file_path: str, hindcast=
     # Set the y-axis to a logarithmic scale
     ax.set_yscale("log")
     ax.set_yticks([0, 10, 25, 50, 100, 250, 500])
-    ax.get_yaxis().set_major_formatter(plt.ScalarFormatter())
+    ax.get_yaxis().set_major_formatter(ScalarFormatter())
     ax.set_ylim(bottom=1)
 
     # Set the labels and title
@@ -64,7 +71,7 @@ def plot_air_quality_forecast(df: pd.DataFrame, place, file_path: str, hindcast=
         every_x_tick = len(place_df.index) / 10
         ax.xaxis.set_major_locator(MultipleLocator(every_x_tick))
 
-    plt.xticks(rotation=45)
+    ax.tick_params(axis="x", labelrotation=45)
 
     if hindcast:
         ax.plot(
@@ -77,12 +84,77 @@ def plot_air_quality_forecast(df: pd.DataFrame, place, file_path: str, hindcast=
             markersize=5,
             markerfacecolor="grey",
         )
-        legend2 = ax.legend(loc="upper left", fontsize="x-small")
+        ax.legend(loc="upper left", fontsize="x-small")
         ax.add_artist(legend1)
 
+
+def plot_air_quality_forecast(df: pd.DataFrame, place, file_path: str, hindcast=False):
+    _fig, ax = plt.subplots(figsize=FIGURE_SIZE)
+
+    place_df = df[df["id"] == place["id"]]
+    _draw(ax, place_df, place, hindcast)
+
     # Ensure everything is laid out neatly
     plt.tight_layout()
 
     # Save the figure, overwriting any existing file with the same name
     plt.savefig(file_path)
     return plt
+
+
+def _render(jobs: list[tuple[pd.DataFrame, dict, str]], hindcast=False) -> list[str]:
+    """Render plots of places to their files, reusing one Agg figure"""
+    fig = Figure(figsize=FIGURE_SIZE)
+    FigureCanvasAgg(fig)
+    for place_df, place, file_path in jobs:
+        fig.clear()
+        _draw(fig.add_subplot(), place_df, place, hindcast)
+        fig.tight_layout()
+        fig.savefig(file_path)
+    fig.clear()
+    return [file_path for _place_df, _place, file_path in jobs]
+
+
+def plot_air_quality_forecasts(
+    df: pd.DataFrame,
+    places,
+    file_path_template: str,
+    hindcast=False,
+    max_workers: int | None = None,
+) -> list[str]:
+    """Plot the forecast of every place to its own image file
+
+    The frame is split by place id once, and plots are drawn off screen on
+    one reused figure, never registered with pyplot, so memory stays constant
+    however many places there are. Many places are split over a process pool.
+
+    Arguments:
+        df: forecasts of all places, with [id, date, predicted_pm25] and
+            pm25 for a hindcast
+        places: place dicts, as in places.json
+        file_path_template: path of each image, formatted with the fields of
+            its place, e.g. "model/images/pm25_{city}_{street}.png"
+        hindcast: also plot the actual pm25
+        max_workers: number of processes, 1 renders in this process
+
+    Returns:
+        list of the paths of the written images, in the order of `places`
+    """
+    places_df = dict(tuple(df.groupby("id", sort=False, observed=True)))
+    empty = df.iloc[:0]
+    jobs = [
+        (places_df.get(place["id"], empty), place, file_path_template.format(**place))
+        for place in places
+    ]
+    for _place_df, _place, file_path in jobs:
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+
+    max_workers = max_workers or min(
+        os.cpu_count() or 1, len(jobs) // MIN_PLACES_PER_WORKER
+    )
+    if max_workers <= 1:
+        return _render(jobs, hindcast)
+    chunks = [jobs[i::max_workers] for i in range(max_workers)]
+    with process_pool(max_workers) as executor:
+        list(executor.map(_render, chunks, [hindcast] * len(chunks)))
+    return [file_path for _place_df, _place, file_path in jobs]
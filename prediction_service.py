@@ -0,0 +1,45 @@
+# %%
+# Serve forecasts from memory over HTTP, updated with pushed air quality readings
+#   GET /forecast/<id>?days=N
+#   POST /readings {"id": ..., "date": "YYYY-MM-DD", "pm25": ...}
+import hops
+import argparse
+import logging
+import inference
+import service
+from dotenv import load_dotenv
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+parser = argparse.ArgumentParser(description="Serve air quality forecasts")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument(
+    "--model-version",
+    type=int,
+    default=inference.MODEL_VERSION,
+    help="version of the model to serve",
+)
+parser.add_argument(
+    "--reload-minutes",
+    type=float,
+    default=60,
+    help="minutes between reloads of the model, weather and lagged air quality",
+)
+# Ignore arguments of interactive kernels
+args, _ = parser.parse_known_args()
+
+# %%
+project = hops.Project(name="ostergotland_air_quality")
+forecast_service = service.ForecastService.from_project(
+    project, version=args.model_version
+)
+# Picks up the next day, new weather forecasts and a re-registered model
+forecast_service.reload_every(args.reload_minutes * 60)
+server = service.make_server(forecast_service, args.host, args.port)
+print(
+    f"Serving forecasts of {len(forecast_service.sensor_ids)} sensors "
+    f"on http://{args.host}:{args.port}"
+)
+server.serve_forever()
@@ -0,0 +1,122 @@
+"""Canonical dtypes of the frames passed between the pipelines
+
+In memory, sensor ids are categorical over the ids in places.json, days are
+datetime64 and measurements float32, which keeps rows small and makes
+grouping, sorting, joining and filtering work on integers. Frames read from
+feature groups, APIs or files go through `coerce`, frames written to feature
+groups through `validate` and `to_storage`, which converts them back to the
+types the feature groups were created with.
+"""
+
+import json
+from functools import lru_cache
+
+import pandas as pd
+
+PLACES_PATH = "places.json"
+# Columns holding days. pandas has no datetime64[D], seconds are its coarsest unit
+DATE_COLUMNS = ("date", "forecast_on")
+DATE_DTYPE = "datetime64[s]"
+FLOAT_DTYPE = "float32"
+
+
+@lru_cache
+def _place_ids(path: str) -> tuple[str, ...]:
+    with open(path) as places_file:
+        return tuple(sorted(json.load(places_file)))
+
+
+def id_dtype(places: dict | None = None) -> pd.CategoricalDtype:
+    """Categorical dtype of sensor ids, over the ids of `places` or places.json"""
+    ids = tuple(sorted(places)) if places is not None else _place_ids(PLACES_PATH)
+    return pd.CategoricalDtype(ids)
+
+
+def as_days(values: pd.Series) -> pd.Series:
+    """Dates, timestamps or date strings as naive datetime64 days"""
+    if values.dtype == DATE_DTYPE:
+        return values
+    return (
+        pd.to_datetime(values, utc=True)
+        .dt.tz_localize(None)
+        .dt.floor("D")
+        .astype(DATE_DTYPE)
+    )
+
+
+def coerce(df: pd.DataFrame, places: dict | None = None) -> pd.DataFrame:
+    """Convert a frame to the canonical dtypes
+
+    Ids become categorical, ids missing from the places are kept as extra
+    categories, see `validate`. Date columns become days and float columns
+    float32, other columns are left as they are.
+
+    Returns:
+        a shallow copy of `df` with converted columns"""
+    df = df.copy(deep=False)
+    if "id" in df.columns:
+        dtype = id_dtype(places)
+        if df["id"].dtype != dtype:
+            ids = df["id"].astype(str)
+            unknown = pd.Index(ids.unique()).difference(dtype.categories)
+            if len(unknown):
+                dtype = pd.CategoricalDtype([*dtype.categories, *sorted(unknown)])
+            df["id"] = ids.astype(dtype)
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = as_days(df[col])
+    for col in df.columns:
+        if pd.api.types.is_float_dtype(df[col]) and df[col].dtype != FLOAT_DTYPE:
+            df[col] = df[col].astype(FLOAT_DTYPE)
+    return df
+
+
+def validate(
+    df: pd.DataFrame, places: dict | None = None, required=("id", "date")
+) -> pd.DataFrame:
+    """Check that a frame has the canonical dtypes and known sensor ids
+
+    Raises:
+        ValueError: listing every problem found
+
+    Returns:
+        `df`, for chaining"""
+    problems = [f"missing column {col}" for col in required if col not in df.columns]
+    if "id" in df.columns:
+        if not isinstance(df["id"].dtype, pd.CategoricalDtype):
+            problems.append(f"id has dtype {df['id'].dtype}, not category")
+        elif df["id"].isna().any():
+            problems.append("id has missing values")
+        else:
+            unknown = df["id"].dtype.categories.difference(id_dtype(places).categories)
+            unknown = unknown.intersection(df["id"].unique())
+            if len(unknown):
+                problems.append(f"unknown ids {list(unknown)}")
+    for col in DATE_COLUMNS:
+        if col not in df.columns:
+            continue
+        if df[col].dtype != DATE_DTYPE:
+            problems.append(f"{col} has dtype {df[col].dtype}, not {DATE_DTYPE}")
+        elif df[col].isna().any():
+            problems.append(f"{col} has missing values")
+    for col in df.columns:
+        if pd.api.types.is_float_dtype(df[col]) and df[col].dtype != FLOAT_DTYPE:
+            problems.append(f"{col} has dtype {df[col].dtype}, not {FLOAT_DTYPE}")
+    if problems:
+        raise ValueError("Invalid frame: " + "; ".join(problems))
+    return df
+
+
+def to_storage(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert a canonical frame to the types of the feature groups, string ids
+    and `datetime.date` days
+
+    Returns:
+        a shallow copy of `df` with converted columns"""
+    df = df.copy(deep=False)
+    if "id" in df.columns:
+        df["id"] = df["id"].astype(str)
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].dt.date
+    return df
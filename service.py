@@ -0,0 +1,261 @@
+import datetime
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+import forecast
+import inference
+
+logger = logging.getLogger(__name__)
+
+
+class ForecastService:
+    def __init__(
+        self,
+        model,
+        feature_names: list[str] | None,
+        batch_data: pd.DataFrame,
+        forecast_on: datetime.date,
+        loader=None,
+    ):
+        """Forecasts of every sensor kept in memory, updated with new readings
+
+        The weather forecast rows of each sensor are kept as they were read by
+        the batch inference, and the last pm25 readings of each sensor as its
+        lag state. A forecast is rolled out again only when a reading is
+        pushed for its sensor, so requests are answered from memory. All of it
+        is read again by `reload`.
+
+        Arguments:
+            model: regressor with a `predict` method
+            feature_names: names of the features as the model expects them
+            batch_data: weather joined with lagged air quality, see
+                `inference.read_batch_data`, from the day after `forecast_on`
+            forecast_on: date of the latest readings in the lagged air quality
+            loader: function returning new (model, feature_names, batch_data,
+                forecast_on) arguments for `reload`
+        """
+        self._loader = loader
+        self.model = model
+        self.feature_columns, self.feature_names = inference.model_columns(
+            batch_data, feature_names
+        )
+        batch_data = batch_data.assign(
+            date=pd.to_datetime(batch_data["date"], utc=True)
+            .dt.tz_localize(None)
+            .dt.date
+        )
+        self._lock = threading.Lock()
+        self._weather = {}
+        self._readings = {}
+        self._forecasts = {}
+        for sensor_id, rows in batch_data.groupby("id", sort=False, observed=True):
+            rows = rows.sort_values("date").reset_index(drop=True)
+            self._weather[sensor_id] = rows
+            # Lag k of the day after forecast_on is the reading k - 1 days before it
+            first_day = rows[rows["date"] == forecast_on + datetime.timedelta(days=1)]
+            readings = {}
+            for k, col in enumerate(forecast.LAG_COLUMNS):
+                if len(first_day) and pd.notna(first_day[col].iloc[0]):
+                    readings[forecast_on - datetime.timedelta(days=k)] = float(
+                        first_day[col].iloc[0]
+                    )
+            self._readings[sensor_id] = (forecast_on, readings)
+            self._forecasts[sensor_id] = self._rollout(sensor_id, forecast_on, readings)
+
+    @classmethod
+    def from_project(
+        cls,
+        project,
+        forecast_on: datetime.date | None = None,
+        version: int = inference.MODEL_VERSION,
+    ) -> "ForecastService":
+        """Service with the model and feature groups of a hops.Project, which
+        reloads the forecasts of today, or of `forecast_on` if it is given"""
+
+        def load():
+            day = forecast_on or datetime.date.today()
+            model, feature_names = inference.load_model(
+                project.model_registry, version
+            )
+            weather_fg, lagged_aq_fg = project.get_feature_groups(
+                [("weather", 2), ("air_quality_lagged", 3)]
+            )
+            start_date = (day + datetime.timedelta(days=1)).isoformat()
+            batch_data = inference.read_batch_data(
+                weather_fg, lagged_aq_fg, start_date
+            )
+            return model, feature_names, batch_data, day
+
+        return cls(*load(), loader=load)
+
+    def _rollout(self, sensor_id, origin: datetime.date, readings: dict) -> list:
+        """Recursive forecast of one sensor for the days after `origin`"""
+        rows = self._weather[sensor_id]
+        rows = rows[rows["date"] > origin].copy()
+        if rows.empty:
+            return []
+        rows[forecast.LAG_COLUMNS] = np.nan
+        if rows["date"].iloc[0] == origin + datetime.timedelta(days=1):
+            rows.loc[rows.index[0], forecast.LAG_COLUMNS] = [
+                readings.get(origin - datetime.timedelta(days=k), np.nan)
+                for k in range(len(forecast.LAG_COLUMNS))
+            ]
+        predictions = forecast.recursive_forecast(
+            self.model,
+            rows,
+            self.feature_columns,
+            lag_columns=forecast.LAG_COLUMNS,
+            feature_names=self.feature_names,
+        )
+        return [
+            {"date": date.isoformat(), "predicted_pm25": round(float(prediction), 2)}
+            for date, prediction in zip(rows["date"], predictions)
+        ]
+
+    @property
+    def sensor_ids(self) -> list:
+        return list(self._forecasts)
+
+    def forecast(self, sensor_id, days: int | None = None) -> list[dict]:
+        """Forecast of a sensor for its next `days` days, or all days known
+
+        Raises:
+            KeyError: for an unknown sensor
+            ValueError: for a negative number of days"""
+        if days is not None and days < 0:
+            raise ValueError(f"days must not be negative, got {days}")
+        return self._forecasts[sensor_id][:days]
+
+    def _push(self, sensor_id, date: datetime.date, pm25: float) -> None:
+        origin, readings = self._readings[sensor_id]
+        origin = max(origin, date)
+        readings = {
+            day: value
+            for day, value in {**readings, date: float(pm25)}.items()
+            if (origin - day).days < len(forecast.LAG_COLUMNS)
+        }
+        self._readings[sensor_id] = (origin, readings)
+        self._forecasts[sensor_id] = self._rollout(sensor_id, origin, readings)
+
+    def push(self, sensor_id, date, pm25: float) -> None:
+        """Add a pm25 reading of a sensor and roll out its forecast again
+
+        A reading for a day after the latest one moves the forecast origin to
+        that day, older readings only update the lags they are part of.
+
+        Raises:
+            KeyError: for an unknown sensor"""
+        date = pd.Timestamp(date).date()
+        with self._lock:
+            self._push(sensor_id, date, pm25)
+
+    def reload(self) -> None:
+        """Read the model, weather forecast and lagged air quality again
+
+        The new state is built while the current one keeps answering requests,
+        then swapped in. Readings pushed for days after the new forecast
+        origin, which the feature store does not have yet, are kept.
+
+        Raises:
+            RuntimeError: for a service created without a loader"""
+        if self._loader is None:
+            raise RuntimeError("The service has no loader to reload from")
+        fresh = ForecastService(*self._loader(), loader=self._loader)
+        with self._lock:
+            for sensor_id, (_origin, readings) in self._readings.items():
+                if sensor_id not in fresh._readings:
+                    continue
+                fresh_origin = fresh._readings[sensor_id][0]
+                for day, value in sorted(readings.items()):
+                    if day > fresh_origin:
+                        fresh._push(sensor_id, day, value)
+            self.model = fresh.model
+            self.feature_columns = fresh.feature_columns
+            self.feature_names = fresh.feature_names
+            self._weather = fresh._weather
+            self._readings = fresh._readings
+            self._forecasts = fresh._forecasts
+
+    def reload_every(self, seconds: float) -> threading.Thread:
+        """Reload the service in a background thread every `seconds` seconds"""
+
+        def run():
+            while True:
+                time.sleep(seconds)
+                try:
+                    self.reload()
+                except Exception:
+                    # Keep serving the current forecasts until a reload succeeds
+                    logger.exception("Reloading the forecast service failed")
+
+        thread = threading.Thread(target=run, name="forecast-reload", daemon=True)
+        thread.start()
+        return thread
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """GET /forecast/<id>?days=N and POST /readings with {id, date, pm25} or
+    a list of them"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _send(self, status: int, body) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "forecast":
+            return self._send(404, {"error": "not found"})
+        try:
+            days = parse_qs(url.query).get("days")
+            days = int(days[0]) if days else None
+            predictions = self.server.service.forecast(parts[1], days)
+        except ValueError:
+            return self._send(400, {"error": "days must be a non-negative integer"})
+        except KeyError:
+            return self._send(404, {"error": f"unknown sensor {parts[1]}"})
+        self._send(200, {"id": parts[1], "forecast": predictions})
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip("/") != "/readings":
+            return self._send(404, {"error": "not found"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            readings = body if isinstance(body, list) else [body]
+            for reading in readings:
+                self.server.service.push(
+                    str(reading["id"]), reading["date"], reading["pm25"]
+                )
+        except KeyError as e:
+            return self._send(404, {"error": f"unknown sensor or field {e}"})
+        except (TypeError, ValueError) as e:
+            return self._send(400, {"error": str(e)})
+        self._send(200, {"updated": len(readings)})
+
+    def log_message(self, format, *args):
+        # Logging every request would cost more than answering it
+        pass
+
+
+def make_server(
+    service: ForecastService, host: str = "127.0.0.1", port: int = 8000
+) -> ThreadingHTTPServer:
+    """HTTP server answering from `service`, one thread per connection"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
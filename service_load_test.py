@@ -0,0 +1,156 @@
+# %%
+# Load test of the prediction service against a local feature store with
+# synthetic sensors, reports latency percentiles and throughput
+import argparse
+import datetime
+import http.client
+import json
+import random
+import socket
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from xgboost import XGBRegressor
+
+import forecast
+import inference
+import local_store
+import service
+
+parser = argparse.ArgumentParser(description="Load test the prediction service")
+parser.add_argument("--sensors", type=int, default=100)
+parser.add_argument("--days", type=int, default=10, help="days of weather forecast")
+parser.add_argument("--clients", type=int, default=8, help="concurrent connections")
+parser.add_argument("--requests", type=int, default=5000, help="requests per client")
+parser.add_argument(
+    "--push-ratio",
+    type=float,
+    default=0.01,
+    help="share of requests pushing a reading rather than reading a forecast",
+)
+# Ignore arguments of interactive kernels
+args, _ = parser.parse_known_args()
+
+# %%
+# Stub feature store with the weather forecast and lags of synthetic sensors
+rng = np.random.default_rng(0)
+today = datetime.date.today()
+ids = [str(10000 + i) for i in range(args.sensors)]
+weather_variables = ["temperature_2m_mean", "precipitation_sum", "wind_speed_10m_max"]
+days = pd.date_range(today + datetime.timedelta(days=1), periods=args.days)
+weather_df = pd.DataFrame(
+    [(sensor_id, day) for day in days for sensor_id in ids], columns=["id", "date"]
+)
+for variable in weather_variables:
+    weather_df[variable] = rng.normal(size=len(weather_df)).astype("float32")
+lagged_df = pd.DataFrame({"id": ids, "date": days[0]})
+for col in forecast.LAG_COLUMNS:
+    lagged_df[col.removeprefix("lagged_aq_")] = rng.uniform(0, 50, len(ids))
+
+store = local_store.Project("load_test", tempfile.mkdtemp()).get_feature_store()
+weather_fg = store.get_or_create_feature_group(
+    name="weather", version=2, primary_key=["id", "date"], event_time="date"
+)
+weather_fg.insert(weather_df)
+lagged_aq_fg = store.get_or_create_feature_group(
+    name="air_quality_lagged", version=3, primary_key=["id", "date"], event_time="date"
+)
+lagged_aq_fg.insert(lagged_df)
+
+# A small model with the feature names of the real one
+feature_names = ["weather_" + variable for variable in weather_variables] + [
+    col.removeprefix("lagged_aq_") for col in forecast.LAG_COLUMNS
+]
+model = XGBRegressor(n_estimators=100, max_depth=6)
+model.fit(
+    pd.DataFrame(rng.normal(size=(1000, len(feature_names))), columns=feature_names),
+    rng.uniform(0, 50, 1000),
+)
+
+# %%
+start = time.perf_counter()
+forecast_service = service.ForecastService(
+    model,
+    feature_names,
+    inference.read_batch_data(weather_fg, lagged_aq_fg, days[0].strftime("%Y-%m-%d")),
+    today,
+)
+print(f"Loaded {args.sensors} sensors in {time.perf_counter() - start:.2f}s")
+
+# In-process lookups, without HTTP
+lookups = []
+for _ in range(10000):
+    sensor_id = random.choice(ids)
+    start = time.perf_counter()
+    forecast_service.forecast(sensor_id, args.days)
+    lookups.append(time.perf_counter() - start)
+print(
+    "In-process forecast: p50 {:.1f}us, p99 {:.1f}us".format(
+        *np.percentile(lookups, [50, 99]) * 1e6
+    )
+)
+
+# %%
+server = service.make_server(forecast_service, port=0)
+host, port = server.server_address
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+forecast_latencies, push_latencies = [], []
+
+
+def client():
+    connection = http.client.HTTPConnection(host, port)
+    connection.connect()
+    connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    forecasts, pushes = [], []
+    for _ in range(args.requests):
+        sensor_id = random.choice(ids)
+        start = time.perf_counter()
+        if random.random() < args.push_ratio:
+            reading = {
+                "id": sensor_id,
+                "date": today.isoformat(),
+                "pm25": random.uniform(0, 50),
+            }
+            connection.request(
+                "POST",
+                "/readings",
+                body=json.dumps(reading),
+                headers={"Content-Type": "application/json"},
+            )
+            latencies = pushes
+        else:
+            connection.request("GET", f"/forecast/{sensor_id}?days={args.days}")
+            latencies = forecasts
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        assert response.status == 200, response.status
+    connection.close()
+    forecast_latencies.extend(forecasts)
+    push_latencies.extend(pushes)
+
+
+start = time.perf_counter()
+clients = [threading.Thread(target=client) for _ in range(args.clients)]
+for thread in clients:
+    thread.start()
+for thread in clients:
+    thread.join()
+elapsed = time.perf_counter() - start
+server.shutdown()
+
+# %%
+total = len(forecast_latencies) + len(push_latencies)
+print(f"{total} requests from {args.clients} clients in {elapsed:.2f}s")
+print(f"Throughput: {total / elapsed:.0f} requests/s")
+for name, latencies in [
+    ("GET forecast", forecast_latencies),
+    ("POST reading", push_latencies),
+]:
+    if latencies:
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+        print(f"{name}: p50 {p50:.3f}ms, p99 {p99:.3f}ms ({len(latencies)} requests)")
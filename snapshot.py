@@ -0,0 +1,137 @@
+import datetime
+import os
+import threading
+import time
+
+import pandas as pd
+
+import schema
+
+# Snapshot written by the batch inference, published by the daily workflow.
+# The dashboard reads it from DASHBOARD_SNAPSHOT, a local path or the URL it is
+# published to, or from this file if it is not set
+SNAPSHOT_FILE = "data/dashboard/snapshot.parquet"
+# Recent forecast accuracy written by the monitoring pipeline. The dashboard
+# reads it from DASHBOARD_ACCURACY, a local path or the URL it is published to,
+# or from this file if it is not set
+ACCURACY_FILE = "data/dashboard/accuracy.parquet"
+# Days of readings and forecasts around today in the snapshot
+HISTORY_DAYS = 14
+FORECAST_DAYS = 14
+
+
+def add_forecast_diff(df_forecast: pd.DataFrame) -> pd.DataFrame:
+    """Add column "forecast_days_before" to indicate
+    how many days before the reading the forecast was made"""
+    days_before = schema.as_days(df_forecast["date"]) - schema.as_days(
+        df_forecast["forecast_on"]
+    )
+    df_forecast["forecast_days_before"] = days_before.dt.days.abs().astype("int16")
+    return df_forecast
+
+
+def read_sources(project, today: datetime.date | None = None) -> tuple:
+    """Air quality readings of the last days and forecasts of the days around
+    today from the feature store
+
+    Returns:
+        tuple of air quality and forecast DataFrames"""
+    today = today or datetime.date.today()
+    air_quality_fg, forecast_fg = project.get_feature_groups(
+        [("air_quality", 2), ("air_quality_forecasts", 3)]
+    )
+    first_day = (today - datetime.timedelta(days=HISTORY_DAYS)).strftime("%Y-%m-%d")
+    last_day = (today + datetime.timedelta(days=FORECAST_DAYS)).strftime("%Y-%m-%d")
+    aq_df = air_quality_fg.filter(air_quality_fg.date >= first_day).read()
+    forecast_df = forecast_fg.filter(
+        (forecast_fg.date >= first_day) & (forecast_fg.date <= last_day)
+    ).read()
+    return aq_df, forecast_df
+
+
+def build(aq_df: pd.DataFrame, forecast_df: pd.DataFrame) -> pd.DataFrame:
+    """Dashboard snapshot of readings and forecasts, sorted by sensor
+
+    Returns:
+        pd.DataFrame with columns [id, date, pm25, predicted_pm25, forecast_on,
+        forecast_days_before], readings have no forecast columns and forecasts
+        no pm25"""
+    readings = schema.coerce(aq_df[["id", "date", "pm25"]])
+    forecasts = add_forecast_diff(
+        schema.coerce(forecast_df[["id", "date", "predicted_pm25", "forecast_on"]])
+    ).drop_duplicates(["id", "date", "forecast_on"], keep="last")
+    snapshot = schema.coerce(pd.concat([readings, forecasts], ignore_index=True))
+    return snapshot.sort_values(["id", "date"], kind="stable").reset_index(drop=True)
+
+
+def write(snapshot: pd.DataFrame, path: str = SNAPSHOT_FILE) -> None:
+    """Write a snapshot atomically, so readers never see a partial file"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    snapshot.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def by_sensor(snapshot: pd.DataFrame) -> dict[str, tuple[pd.DataFrame, pd.DataFrame]]:
+    """Readings and forecasts of each sensor"""
+    is_forecast = snapshot["forecast_on"].notna()
+    readings = snapshot[~is_forecast][["id", "date", "pm25"]]
+    readings = dict(tuple(readings.groupby("id", observed=True)))
+    forecasts = dict(
+        tuple(snapshot[is_forecast].drop(columns="pm25").groupby("id", observed=True))
+    )
+    empty_readings = snapshot.iloc[:0][["id", "date", "pm25"]]
+    empty_forecasts = snapshot.iloc[:0].drop(columns="pm25")
+    return {
+        sensor_id: (
+            readings.get(sensor_id, empty_readings),
+            forecasts.get(sensor_id, empty_forecasts),
+        )
+        for sensor_id in snapshot["id"].unique().tolist()
+    }
+
+
+def load(path: str | None = None) -> dict[str, tuple[pd.DataFrame, pd.DataFrame]]:
+    """Readings and forecasts of each sensor from a snapshot, by default the one
+    at DASHBOARD_SNAPSHOT"""
+    # Read on every call, after the dashboard loads its .env
+    path = path or os.environ.get("DASHBOARD_SNAPSHOT", SNAPSHOT_FILE)
+    return by_sensor(pd.read_parquet(path))
+
+
+class StaleWhileRevalidate:
+    def __init__(self, load, ttl: float = 600):
+        """Value returned from memory, reloaded in a background thread once it
+        is older than `ttl` seconds
+
+        Only the first call waits for `load`, later calls get the last loaded
+        value while a newer one is loading. A failed reload keeps the old
+        value and is retried on the next call."""
+        self._load = load
+        self.ttl = ttl
+        self._value = None
+        self._loaded_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _refresh(self) -> None:
+        try:
+            value = self._load()
+            with self._lock:
+                self._value, self._loaded_at = value, time.monotonic()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get(self):
+        with self._lock:
+            loaded = self._loaded_at is not None
+            stale = loaded and time.monotonic() - self._loaded_at > self.ttl
+            if stale and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._refresh, daemon=True).start()
+        if not loaded:
+            value = self._load()
+            with self._lock:
+                self._value, self._loaded_at = value, time.monotonic()
+        return self._value
@@ -0,0 +1,537 @@
+import datetime
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xgboost
+from sklearn.metrics import mean_squared_error, r2_score
+from xgboost import XGBRegressor
+
+import schema
+from helper import add_lagged_features, asof_join, process_pool
+
+MODEL_NAME = "air_quality_xgboost_model"
+DIRECT_MODEL_NAME = "air_quality_xgboost_direct_models"
+# Number of lagged pm25 features the models use
+N_LAGS = 3
+
+# Columns of the training data that are not model features
+NON_FEATURE_COLUMNS = ["id", "date"]
+# How many days older than the air quality reading joined features may be
+JOIN_TOLERANCE_DAYS = 0
+# Dates in model metrics are days since this day, as metrics must be numbers
+METRICS_EPOCH = datetime.date(1970, 1, 1)
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_features(X: pd.DataFrame) -> pd.DataFrame:
+    """Create features by removing unnecessary columns and the lagged_aq_ prefix"""
+    return X.drop(columns=NON_FEATURE_COLUMNS).rename(
+        columns={
+            col: col.replace("lagged_aq_", "")
+            for col in X.columns
+            if col.startswith("lagged_aq_")
+        },
+    )
+
+
+def _read_since(feature_group, start_time: str | None) -> pd.DataFrame:
+    if start_time is None:
+        return schema.coerce(feature_group.read())
+    return schema.coerce(feature_group.filter(feature_group.date >= start_time).read())
+
+
+def read_training_data(
+    air_quality_fg,
+    weather_fg,
+    lagged_aq_fg,
+    start_time: str | None = None,
+    tolerance_days: int = JOIN_TOLERANCE_DAYS,
+) -> pd.DataFrame:
+    """Air quality readings since `start_time` joined with their weather and
+    lagged air quality on (id, date), one row per sensor-day
+
+    Returns:
+        pd.DataFrame with columns [id, date, pm25, weather_..., lagged_aq_...]"""
+    lookback_time = start_time
+    if start_time is not None:
+        lookback_time = (
+            pd.Timestamp(start_time) - pd.Timedelta(days=tolerance_days)
+        ).strftime("%Y-%m-%d")
+    return asof_join(
+        _read_since(air_quality_fg, start_time)[["id", "date", "pm25"]],
+        [
+            (_read_since(weather_fg, lookback_time), "weather_"),
+            (_read_since(lagged_aq_fg, lookback_time), "lagged_aq_"),
+        ],
+        tolerance_days=tolerance_days,
+    )
+
+
+def materialize_training_data(
+    feature_view,
+    read_rows,
+    cache_dir: str = "data/training-sets",
+    refresh: bool = False,
+    load: bool = True,
+) -> pd.DataFrame | list[Path]:
+    """All training data of a feature view, materialized as local Parquet
+
+    Rows are appended in parts named after their latest event date. Later calls
+    only read rows with an event date after the latest one cached (the
+    watermark), rows changed before it need a `refresh`.
+
+    Arguments:
+        feature_view: feature view the training data belongs to
+        read_rows: function reading the training data since a start time
+            ("%Y-%m-%d", or None for all), e.g. `read_training_data`
+        load: whether to load the training data, or only return its parts
+
+    Returns:
+        pd.DataFrame with the training data, or the paths of its Parquet parts"""
+    cache = Path(cache_dir) / f"{feature_view.name}_{feature_view.version}"
+    if refresh:
+        for part in cache.glob("*.parquet"):
+            part.unlink()
+    cache.mkdir(parents=True, exist_ok=True)
+    parts = sorted(cache.glob("*.parquet"))
+    watermark = datetime.date.fromisoformat(parts[-1].stem) if parts else None
+
+    start_time = None
+    if watermark is not None:
+        start_time = (watermark + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    new_rows = read_rows(start_time)
+    logger.info("Training data: %d new rows after %s", len(new_rows.index), watermark)
+    if not new_rows.empty:
+        latest = pd.to_datetime(new_rows["date"]).max().strftime("%Y-%m-%d")
+        new_rows.to_parquet(cache / f"{latest}.parquet", index=False)
+        parts.append(cache / f"{latest}.parquet")
+    if not load:
+        return parts
+    return schema.coerce(
+        pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+    )
+
+
+def train_test_split(
+    training_data: pd.DataFrame,
+    labels: list[str],
+    test_start: str,
+    train_start: str | None = None,
+) -> tuple:
+    """Split training data by date like FeatureView.train_test_split: train
+    from `train_start` until `test_start`, test from `test_start` on
+
+    Returns:
+        X_train, X_test, y_train, y_test"""
+    days = schema.as_days(training_data["date"])
+    in_train = days < pd.Timestamp(test_start)
+    if train_start is not None:
+        in_train &= days >= pd.Timestamp(train_start)
+    train = training_data[in_train].reset_index(drop=True)
+    test = training_data[days >= pd.Timestamp(test_start)].reset_index(drop=True)
+    return (
+        train.drop(columns=labels),
+        test.drop(columns=labels),
+        train[labels],
+        test[labels],
+    )
+
+
+def write_training_arrow(
+    parts: list[Path],
+    labels: list[str],
+    test_start: str,
+    train_start: str | None = None,
+    path: str = "data/training-arrow/train.arrow",
+    batch_rows: int = 65536,
+) -> tuple[str | None, pd.DataFrame, datetime.date | None]:
+    """Stream training data parts into an Arrow IPC file of float32 features
+
+    Parts are read `batch_rows` at a time and split like `train_test_split`.
+    Training rows are written to `path` as prepared features and labels, so
+    only one batch is held in memory. Test rows are kept in memory.
+
+    Returns:
+        the Arrow file path (None if there are no training rows), the test
+        rows, and the last date of the training rows"""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    writer, test_batches, last_date = None, [], None
+    for part in parts:
+        for record_batch in pq.ParquetFile(part).iter_batches(batch_size=batch_rows):
+            batch = record_batch.to_pandas()
+            X_train, X_test, y_train, y_test = train_test_split(
+                batch, labels, test_start, train_start
+            )
+            test_batches.append(pd.concat([X_test, y_test], axis=1))
+            if X_train.empty:
+                continue
+            batch_last_date = pd.to_datetime(X_train["date"]).max().date()
+            last_date = max(last_date or batch_last_date, batch_last_date)
+            features = prepare_features(X_train).astype("float32")
+            features[labels] = y_train.astype("float32")
+            table = pa.Table.from_pandas(features, preserve_index=False)
+            if writer is None:
+                writer = pa.ipc.new_file(path, table.schema)
+            writer.write_table(table, max_chunksize=batch_rows)
+    if writer is not None:
+        writer.close()
+    test_data = pd.concat(test_batches, ignore_index=True)
+    return (path if writer is not None else None), test_data, last_date
+
+
+class ArrowBatches(xgboost.DataIter):
+    """Feeds XGBoost the record batches of a memory-mapped Arrow IPC file"""
+
+    def __init__(
+        self,
+        path: str,
+        feature_names: list[str],
+        label: str,
+        cache_prefix: str | None = None,
+    ):
+        self._reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+        self._feature_names = feature_names
+        self._label = label
+        self._batch = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data) -> int:
+        if self._batch == self._reader.num_record_batches:
+            return 0
+        batch = self._reader.get_batch(self._batch)
+        # Missing values are nulls in Arrow, copied out as NaN
+        input_data(
+            data=np.column_stack(
+                [
+                    batch.column(name).to_numpy(zero_copy_only=False)
+                    for name in self._feature_names
+                ]
+            ),
+            label=batch.column(self._label).to_numpy(zero_copy_only=False),
+            feature_names=self._feature_names,
+        )
+        self._batch += 1
+        return 1
+
+    def reset(self) -> None:
+        self._batch = 0
+
+
+def fit_out_of_core(
+    path: str,
+    feature_names: list[str],
+    label: str,
+    params: dict | None = None,
+    xgb_model: xgboost.Booster | None = None,
+    external_memory: bool = False,
+) -> XGBRegressor:
+    """Train an XGBRegressor on an Arrow file written by `write_training_arrow`
+
+    The data is read batch by batch into a QuantileDMatrix, which only keeps
+    the quantized features. With `external_memory`, even those are paged to
+    disk next to `path`.
+
+    Arguments:
+        path: Arrow IPC file with the features and the label
+        feature_names: features to train on, in this order
+        label: label column
+        params: XGBRegressor parameters
+        xgb_model: booster to continue training
+
+    Returns:
+        the trained model"""
+    regressor = XGBRegressor(**(params or {}))
+    if external_memory:
+        batches = ArrowBatches(path, feature_names, label, cache_prefix=path + ".cache")
+        dtrain = xgboost.DMatrix(batches)
+    else:
+        dtrain = xgboost.QuantileDMatrix(ArrowBatches(path, feature_names, label))
+    booster = xgboost.train(
+        regressor.get_xgb_params(),
+        dtrain,
+        num_boost_round=regressor.get_num_boosting_rounds(),
+        xgb_model=xgb_model,
+    )
+    regressor.load_model(bytearray(booster.save_raw("ubj")))
+    return regressor
+
+
+def latest_model(model_registry, name: str = MODEL_NAME):
+    """Latest registered version of a model, None if there is none"""
+    models = model_registry.get_models(name=name) or []
+    return max(models, key=lambda model: model.version, default=None)
+
+
+def date_metric(day: datetime.date) -> str:
+    """A date as a model metric, the number of days since METRICS_EPOCH"""
+    return str((day - METRICS_EPOCH).days)
+
+
+def _metric_date(value) -> datetime.date | None:
+    if value is None or value == "":
+        return None
+    if isinstance(value, str) and "-" in value[1:]:
+        # Local models registered before dates were stored as numbers
+        return datetime.date.fromisoformat(value)
+    return METRICS_EPOCH + datetime.timedelta(days=int(float(value)))
+
+
+def training_metadata(model) -> tuple[datetime.date | None, datetime.date | None]:
+    """Training cutoff and last full refit date stored in a model's metrics,
+    see `date_metric`"""
+    metrics = (model.training_metrics or {}) if model is not None else {}
+    return (
+        _metric_date(metrics.get("training_cutoff")),
+        _metric_date(metrics.get("last_full_refit")),
+    )
+
+
+def choose_mode(mode: str, model, full_refit_days: int) -> str:
+    """Resolve the "auto" training mode to "full" or "incremental"
+
+    Training is incremental if there is a model to continue from, unless its
+    last full refit is more than `full_refit_days` old."""
+    cutoff, last_full_refit = training_metadata(model)
+    if mode == "incremental" and cutoff is None:
+        logger.info("No model with a training cutoff to continue from, full refit")
+        return "full"
+    if mode != "auto":
+        return mode
+    if cutoff is None or last_full_refit is None:
+        return "full"
+    refit_due = last_full_refit + datetime.timedelta(days=full_refit_days)
+    return "full" if datetime.date.today() >= refit_due else "incremental"
+
+
+def rolling_origin_folds(
+    dates: pd.Series, n_folds: int = 4, horizon_days: int = 7
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Time series cross-validation folds with a rolling forecast origin
+
+    The last `n_folds * horizon_days` days are cut into consecutive validation
+    windows, each fold trains on all days before its window.
+
+    Returns:
+        list of (train, validation) row index arrays"""
+    days = pd.to_datetime(dates).dt.normalize().to_numpy()
+    last_day = days.max()
+    folds = []
+    for fold in range(n_folds, 0, -1):
+        origin = last_day - np.timedelta64(fold * horizon_days - 1, "D")
+        valid_end = origin + np.timedelta64(horizon_days, "D")
+        train = np.flatnonzero(days < origin)
+        valid = np.flatnonzero((days >= origin) & (days < valid_end))
+        if len(train) and len(valid):
+            folds.append((train, valid))
+    return folds
+
+
+def sample_candidates(n: int, seed: int = 0) -> list[dict]:
+    """Random XGBoost hyperparameter configurations"""
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "learning_rate": float(10 ** rng.uniform(-2, -0.5)),
+            "max_depth": int(rng.integers(2, 9)),
+            "min_child_weight": float(10 ** rng.uniform(0, 1.5)),
+            "subsample": float(rng.uniform(0.5, 1)),
+            "colsample_bytree": float(rng.uniform(0.5, 1)),
+            "reg_lambda": float(10 ** rng.uniform(-1, 1)),
+        }
+        for _ in range(n)
+    ]
+
+
+# Columns of search results that are not hyperparameters
+SEARCH_METRICS = ["cv_rmse", "cv_rmse_std"]
+
+
+def best_params(search_results: pd.DataFrame) -> dict:
+    """Hyperparameters of the best configuration of a search"""
+    best = search_results.drop(columns=SEARCH_METRICS).iloc[0].to_dict()
+    for param in ("max_depth", "n_estimators"):
+        best[param] = int(best[param])
+    return best
+
+
+# Training data of search workers, set once per worker by _init_search_worker
+_search_data = None
+
+
+def _init_search_worker(X, y, folds, nthread, max_rounds, early_stopping_rounds):
+    global _search_data
+    _search_data = (X, y, folds, nthread, max_rounds, early_stopping_rounds)
+
+
+def _evaluate(params: dict) -> dict:
+    """Cross-validate one configuration, with early stopping in every fold"""
+    X, y, folds, nthread, max_rounds, early_stopping_rounds = _search_data
+    rmses, rounds = [], []
+    for train, valid in folds:
+        model = XGBRegressor(
+            **params,
+            n_estimators=max_rounds,
+            early_stopping_rounds=early_stopping_rounds,
+            n_jobs=nthread,
+        )
+        model.fit(
+            X.iloc[train],
+            y.iloc[train],
+            eval_set=[(X.iloc[valid], y.iloc[valid])],
+            verbose=False,
+        )
+        # Predictions use the best iteration found by early stopping
+        errors = y.iloc[valid].to_numpy().ravel() - model.predict(X.iloc[valid])
+        rmses.append(float(np.sqrt(np.mean(errors**2))))
+        rounds.append(model.best_iteration + 1)
+    return {
+        **params,
+        "cv_rmse": float(np.mean(rmses)),
+        "cv_rmse_std": float(np.std(rmses)),
+        "n_estimators": int(np.mean(rounds)),
+    }
+
+
+def search(
+    X: pd.DataFrame,
+    y: pd.DataFrame,
+    dates: pd.Series,
+    candidates: list[dict],
+    n_folds: int = 4,
+    horizon_days: int = 7,
+    max_rounds: int = 1000,
+    early_stopping_rounds: int = 20,
+    max_workers: int | None = None,
+    nthread: int = 2,
+) -> pd.DataFrame:
+    """Rank hyperparameter configurations by rolling origin cross-validation
+
+    Configurations are evaluated in parallel processes, each training with
+    `nthread` threads, so that workers x threads matches the number of CPUs.
+
+    Returns:
+        pd.DataFrame with one row per configuration, best first, with its
+        parameters, cv_rmse, cv_rmse_std and the number of boosting rounds
+        (n_estimators) early stopping settled on"""
+    folds = rolling_origin_folds(dates, n_folds, horizon_days)
+    if not folds:
+        raise ValueError("Not enough history for any cross-validation fold")
+    max_workers = max_workers or max(1, (os.cpu_count() or 1) // nthread)
+    with process_pool(
+        max_workers,
+        initializer=_init_search_worker,
+        initargs=(X, y, folds, nthread, max_rounds, early_stopping_rounds),
+    ) as executor:
+        results = list(executor.map(_evaluate, candidates))
+    results = pd.DataFrame(results).sort_values("cv_rmse", kind="stable")
+    return results.reset_index(drop=True)
+
+
+def direct_horizon_features(
+    training_data: pd.DataFrame, horizons: list[int], n_lags: int = N_LAGS
+) -> dict[int, pd.DataFrame]:
+    """Features of a direct model for each forecast horizon
+
+    The model for horizon h predicts pm25 h days after the last known reading,
+    from the weather of the target day and the n_lags readings up to h days
+    before it. Lags are named as for the recursive model (pm25_lagged_1d is
+    the latest known reading), so all horizons share their feature names.
+
+    Returns:
+        dict of horizon to features, aligned with the rows of `training_data`"""
+    lags = range(min(horizons), max(horizons) + n_lags)
+    lagged = add_lagged_features(
+        training_data[["id", "date", "pm25"]], "pm25", lags=tuple(lags)
+    ).sort_index()
+    weather = training_data[
+        [col for col in training_data.columns if col.startswith("weather_")]
+    ]
+    return {
+        horizon: weather.assign(
+            **{
+                f"pm25_lagged_{lag}d": lagged[f"pm25_lagged_{horizon + lag - 1}d"]
+                for lag in range(1, n_lags + 1)
+            }
+        )
+        for horizon in horizons
+    }
+
+
+# Training data of direct model workers, set once per worker
+_direct_data = None
+
+
+def _init_direct_worker(features, y, dates, test_start, params, nthread):
+    global _direct_data
+    _direct_data = (features, y, dates, test_start, params, nthread)
+
+
+def _fit_horizon(horizon: int) -> tuple[int, bytearray, float, float]:
+    """Train the direct model of one horizon, returns it as a raw booster and
+    its test MSE and R squared"""
+    features, y, dates, test_start, params, nthread = _direct_data
+    X = features[horizon]
+    train, test = (dates < test_start).to_numpy(), (dates >= test_start).to_numpy()
+    model = XGBRegressor(**params, n_jobs=nthread)
+    model.fit(X[train], y[train])
+    y_pred = model.predict(X[test])
+    mse = float(mean_squared_error(y[test].iloc[:, 0], y_pred))
+    r2 = float(r2_score(y[test].iloc[:, 0], y_pred))
+    return horizon, model.get_booster().save_raw("ubj"), mse, r2
+
+
+def train_direct_models(
+    training_data: pd.DataFrame,
+    horizons: list[int],
+    test_start: str,
+    params: dict | None = None,
+    max_workers: int | None = None,
+) -> tuple[dict[int, XGBRegressor], pd.DataFrame]:
+    """Train one direct model per forecast horizon, in parallel processes
+
+    Returns:
+        dict of horizon to model, and a table of test MSE and R squared
+        per horizon"""
+    features = direct_horizon_features(training_data, horizons)
+    dates = pd.to_datetime(training_data["date"]).dt.strftime("%Y-%m-%d")
+    max_workers = max_workers or min(len(horizons), os.cpu_count() or 1)
+    nthread = max(1, (os.cpu_count() or 1) // max_workers)
+    with process_pool(
+        max_workers,
+        initializer=_init_direct_worker,
+        initargs=(
+            features,
+            training_data[["pm25"]],
+            dates,
+            test_start,
+            params or {},
+            nthread,
+        ),
+    ) as executor:
+        results = list(executor.map(_fit_horizon, horizons))
+    models = {}
+    for horizon, raw_model, _mse, _r2 in results:
+        models[horizon] = XGBRegressor()
+        models[horizon].load_model(raw_model)
+    metrics = pd.DataFrame(
+        [(horizon, mse, r2) for horizon, _raw, mse, r2 in results],
+        columns=["horizon", "MSE", "R squared"],
+    )
+    return models, metrics
+
+
+def save_direct_models(models: dict[int, XGBRegressor], model_dir: str) -> None:
+    """Save a family of direct models as one bundle directory, which
+    `model_cache.get_model` loads as a dict of horizon to model"""
+    os.makedirs(model_dir, exist_ok=True)
+    for horizon, model in models.items():
+        model.save_model(f"{model_dir}/h{horizon}.json")
+    with open(f"{model_dir}/bundle.json", "w") as bundle:
+        json.dump({"horizons": sorted(models)}, bundle)
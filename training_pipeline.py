@@ -6,9 +6,15 @@
 import os
 import sys
 import json
+import logging
+import argparse
 import hops
+import training
+import model_cache
+import pandas as pd
 from datetime import datetime, timedelta
-from plot import plot_air_quality_forecast
+import matplotlib.pyplot as plt
+from plot import plot_air_quality_forecasts
 from xgboost import XGBRegressor
 from xgboost import plot_importance
 from sklearn.metrics import mean_squared_error, r2_score
@@ -16,12 +22,80 @@ from sklearn.metrics import mean_squared_error, r2_score
 from dotenv import load_dotenv
 
 load_dotenv()
+logging.basicConfig(level=logging.INFO)
 
 
 def is_interactive():
     return hasattr(sys, "ps1")
 
 
+parser = argparse.ArgumentParser(description="Train the air quality model")
+parser.add_argument(
+    "--mode",
+    choices=["full", "incremental", "auto"],
+    default="full",
+    help="refit on all history, continue boosting the latest model on rows added "
+    "since its training cutoff, or pick incremental unless a full refit is due",
+)
+parser.add_argument(
+    "--extra-rounds",
+    type=int,
+    default=20,
+    help="boosting rounds added in incremental mode",
+)
+parser.add_argument(
+    "--full-refit-days",
+    type=int,
+    default=7,
+    help="days between full refits in auto mode",
+)
+parser.add_argument(
+    "--search",
+    type=int,
+    default=0,
+    metavar="N",
+    help="on a full refit, pick hyperparameters from N random configurations "
+    "by time series cross-validation",
+)
+parser.add_argument(
+    "--search-nthread",
+    type=int,
+    default=2,
+    help="threads per configuration during the search",
+)
+parser.add_argument(
+    "--refresh-training-data",
+    action="store_true",
+    help="rebuild the local training data cache from the feature view",
+)
+parser.add_argument(
+    "--out-of-core",
+    action="store_true",
+    help="train from memory-mapped Arrow batches instead of in-memory frames",
+)
+parser.add_argument(
+    "--external-memory",
+    action="store_true",
+    help="with --out-of-core, also page the quantized training data to disk",
+)
+parser.add_argument(
+    "--direct-horizons",
+    type=int,
+    default=0,
+    metavar="N",
+    help="also train direct models for forecast horizons 1 to N days, "
+    "registered as one bundle",
+)
+# Ignore arguments of interactive kernels
+args, _ = parser.parse_known_args()
+if args.out_of_core and args.search:
+    parser.error("--search needs the training data in memory, not --out-of-core")
+if args.out_of_core and args.direct_horizons:
+    parser.error(
+        "--direct-horizons needs the training data in memory, not --out-of-core"
+    )
+
+
 # %%
 project = hops.Project(name="ostergotland_air_quality")
 air_quality_fg, weather_fg, lagged_air_quality_fg = project.get_feature_groups(
@@ -29,14 +103,16 @@ air_quality_fg, weather_fg, lagged_air_quality_fg = project.get_feature_groups(
 )
 selected_features = (
     air_quality_fg.select(["id", "pm25", "date"])
-    .join(weather_fg.select_all(), on="id", prefix="weather_")
-    .join(lagged_air_quality_fg.select_all(), on="id", prefix="lagged_aq_")
+    .join(weather_fg.select_all(), on=["id", "date"], prefix="weather_")
+    .join(lagged_air_quality_fg.select_all(), on=["id", "date"], prefix="lagged_aq_")
 )
 
+# Describes the training data for the model registry, the data itself is read
+# by training.read_training_data with the same (id, date) join
 feature_view = project.feature_store.get_or_create_feature_view(
     name="air_quality_fv",
     description="weather features with air quality as the target",
-    version=6,
+    version=7,
     inference_helper_columns=["id"],
     training_helper_columns=["id"],
     labels=["pm25"],
@@ -44,44 +120,95 @@ feature_view = project.feature_store.get_or_create_feature_view(
 )
 
 # %%
+mr = project.model_registry
+previous_model = training.latest_model(mr)
+mode = training.choose_mode(args.mode, previous_model, args.full_refit_days)
+training_cutoff, last_full_refit = training.training_metadata(previous_model)
+print("Training mode:", mode)
+
 test_start = (datetime.today() - timedelta(days=7)).strftime("%Y-%m-%d")
+# Incremental training only reads rows added since the previous model's cutoff
+train_start = None
+if mode == "incremental":
+    train_start = (training_cutoff + timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+# The joined training data is cached locally, only new rows are read
+def read_rows(start_time):
+    return training.read_training_data(
+        air_quality_fg, weather_fg, lagged_air_quality_fg, start_time
+    )
 
-X_train, X_test, y_train, y_test = feature_view.train_test_split(
-    test_start=test_start, primary_key=True
-)
-X_train.head()
+
+if args.out_of_core:
+    # Training rows go to memory-mapped Arrow batches, only test rows are loaded
+    training_parts = training.materialize_training_data(
+        feature_view, read_rows, refresh=args.refresh_training_data, load=False
+    )
+    train_arrow, test_data, train_last_date = training.write_training_arrow(
+        training_parts, ["pm25"], test_start, train_start
+    )
+    X_test, y_test = test_data.drop(columns=["pm25"]), test_data[["pm25"]]
+    has_train_rows = train_arrow is not None
+else:
+    training_data = training.materialize_training_data(
+        feature_view, read_rows, refresh=args.refresh_training_data
+    )
+    X_train, X_test, y_train, y_test = training.train_test_split(
+        training_data, labels=["pm25"], test_start=test_start, train_start=train_start
+    )
+    has_train_rows = not X_train.empty
+    if has_train_rows:
+        train_last_date = pd.to_datetime(X_train["date"]).max().date()
+if not has_train_rows:
+    print("No new training data since", training_cutoff)
+    sys.exit(0)
 
 # %%
-# Create features by removing unnecessary columns
-columns_to_drop = [
-    "date",
-    "weather_date",
-    "lagged_aq_date",
-    "weather_id",
-    "ostergotland_air_quality_air_quality_2_id",
-    "lagged_aq_id",
-]
-X_features = X_train.drop(columns=columns_to_drop).rename(
-    columns={
-        col: col.replace("lagged_aq_", "")
-        for col in X_train.columns
-        if col.startswith("lagged_aq_")
-    },
-)
-X_test_features = X_test.drop(columns=columns_to_drop).rename(
-    columns={
-        col: col.replace("lagged_aq_", "")
-        for col in X_test.columns
-        if col.startswith("lagged_aq_")
-    },
-)
-print(y_train.head())
-X_features.head()
-X_features.info()
+X_test_features = training.prepare_features(X_test)
+if not args.out_of_core:
+    X_features = training.prepare_features(X_train)
+    print(y_train.head())
+    X_features.info()
 
 # %%
-xgb_regressor = XGBRegressor()
-xgb_regressor.fit(X_features, y_train)
+xgb_params = {}
+previous_booster = None
+feature_names = list(X_test_features.columns)
+if mode == "incremental":
+    # Continue boosting the previous model with a few extra rounds
+    previous_xgb, feature_names = model_cache.get_model(
+        mr, name=training.MODEL_NAME, version=previous_model.version
+    )
+    xgb_params = {**previous_xgb.get_params(), "n_estimators": args.extra_rounds}
+    previous_booster = previous_xgb.get_booster()
+elif args.search:
+    search_results = training.search(
+        X_features,
+        y_train,
+        X_train["date"],
+        training.sample_candidates(args.search),
+        nthread=args.search_nthread,
+    )
+    print(search_results.head(10))
+    xgb_params = training.best_params(search_results)
+
+X_test_features = X_test_features[feature_names]
+if args.out_of_core:
+    xgb_regressor = training.fit_out_of_core(
+        train_arrow,
+        feature_names,
+        "pm25",
+        xgb_params,
+        xgb_model=previous_booster,
+        external_memory=args.external_memory,
+    )
+else:
+    xgb_regressor = XGBRegressor(**xgb_params)
+    xgb_regressor.fit(X_features[feature_names], y_train, xgb_model=previous_booster)
+if mode == "full":
+    last_full_refit = datetime.today().date()
+training_cutoff = max(train_last_date, training_cutoff or datetime.min.date())
 y_pred = xgb_regressor.predict(X_test_features)
 mse = mean_squared_error(y_test.iloc[:, 0], y_pred)
 print("MSE:", mse)
@@ -106,16 +233,15 @@ os.makedirs("model", exist_ok=True)
 img_dir = "model/images"
 os.makedirs(img_dir, exist_ok=True)
 
-df["id"] = X_test["weather_id"]
-for place in places.values():
-    plt = plot_air_quality_forecast(
-        df,
-        place,
-        img_dir + f"/pm25_forecast_{place['city']}_{place['street']}.png",
-        hindcast=True,
-    )
-    if is_interactive():
-        plt.show()
+df["id"] = X_test["id"]
+# One hindcast image per place, rendered off screen
+image_paths = plot_air_quality_forecasts(
+    df,
+    places.values(),
+    img_dir + "/pm25_forecast_{city}_{street}.png",
+    hindcast=True,
+)
+print(f"Wrote {len(image_paths)} hindcast plots to {img_dir}")
 
 
 # %%
@@ -126,11 +252,18 @@ xgb_regressor.save_model(model_file)
 res_dict = {
     "MSE": str(mse),
     "R squared": str(r2),
+    # Used by incremental training to find the rows added since this model,
+    # as days since training.METRICS_EPOCH since metrics must be numbers
+    "training_cutoff": training.date_metric(training_cutoff),
+    "last_full_refit": training.date_metric(last_full_refit),
 }
-mr = project.model_registry
+if mode == "full" and args.search:
+    res_dict["CV RMSE"] = str(search_results["cv_rmse"].iloc[0])
+    res_dict["CV RMSE std"] = str(search_results["cv_rmse_std"].iloc[0])
+    search_results.to_csv(model_dir + "/search_results.csv", index=False)
 # Creating a Python model in the model registry named 'air_quality_xgboost_model'
 aq_model = mr.python.create_model(
-    name="air_quality_xgboost_model",
+    name=training.MODEL_NAME,
     metrics=res_dict,
     feature_view=feature_view,
     description="Air Quality (PM2.5) predictor",
@@ -145,3 +278,28 @@ feature_importance_path = img_dir + "/feature_importance.png"
 plt.savefig(feature_importance_path)
 if is_interactive():
     plt.show()
+
+# %%
+# Direct models predict each horizon from the features known on the forecast day,
+# so batch inference can predict all days at once instead of day by day
+if args.direct_horizons:
+    direct_models, direct_metrics = training.train_direct_models(
+        training_data,
+        list(range(1, args.direct_horizons + 1)),
+        test_start,
+        params=xgb_params if mode == "full" else None,
+    )
+    print(direct_metrics)
+    direct_dir = model_dir + "/direct"
+    training.save_direct_models(direct_models, direct_dir)
+    direct_metrics.to_csv(direct_dir + "/metrics.csv", index=False)
+    direct_model = mr.python.create_model(
+        name=training.DIRECT_MODEL_NAME,
+        metrics={
+            f"MSE {horizon}d": str(mse)
+            for horizon, mse in zip(direct_metrics["horizon"], direct_metrics["MSE"])
+        },
+        feature_view=feature_view,
+        description="Air Quality (PM2.5) predictors, one per forecast horizon",
+    )
+    direct_model.save(direct_dir)
@@ -1,9 +1,17 @@
+import logging
+
+import numpy as np
 import pandas as pd
-import requests_cache
-from datetime import date
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
 import openmeteo_requests
 from retry_requests import retry
 
+import schema
+from helper import RateLimiter
+from weather_store import CELL_KEY, WeatherStore
+
 OPENMETEO_DAILY_VARIABLES = [
     "wind_speed_10m_max",
     "wind_gusts_10m_max",
@@ -26,118 +34,395 @@ OPENMETEO_DAILY_VARIABLES = [
     "temperature_2m_mean",
     "apparent_temperature_mean",
 ]
+# Daily variables that the API returns as int64 unix timestamps
+OPENMETEO_INT64_VARIABLES = {"sunset", "sunrise"}
 
 
-def get_forecast(forecast_days: int, places: dict[str, dict]) -> pd.DataFrame:
-    cache_session = requests_cache.CachedSession(".cache", expire_after=3600)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+ARCHIVE_URL = "https://archive-api.open-meteo.com/v1/archive"
+# Forecast cells fetched before the latest issue are considered expired
+FORECAST_ISSUE_INTERVAL = pd.Timedelta(hours=1)
+# Archive cells with missing values fetched within this long after their day
+# may still be filled in, older ones are final
+ARCHIVE_DELAY = pd.Timedelta(days=7)
+# Daily variables stored with every cell, to find cells fetched before one was added
+VARIABLES_KEY = ",".join(OPENMETEO_DAILY_VARIABLES)
+
+logger = logging.getLogger(__name__)
+
+
+def decode_daily(
+    responses: list,
+    place_ids: list[str],
+    daily_vars: list[str] | None = None,
+    dropna: bool = True,
+) -> pd.DataFrame:
+    """Decode the Daily() block of Open-Meteo responses into a single DataFrame
+
+    All columns are written into buffers preallocated for every location and
+    day, so decoding is linear in locations x days and the frame is built once.
+
+    Arguments:
+        responses: Open-Meteo responses, one per place
+        place_ids: id of the place for each response (same order)
+        daily_vars: daily variables in the order they were requested
+        dropna: whether to drop days with missing values
 
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": [place["latitude"] for place in places.values()],
-        "longitude": [place["longitude"] for place in places.values()],
-        "forecast_days": forecast_days,
-        "daily": OPENMETEO_DAILY_VARIABLES,
+    Returns:
+        pd.DataFrame with columns [id, date, daily_vars...]"""
+    if daily_vars is None:
+        daily_vars = OPENMETEO_DAILY_VARIABLES
+    dailies = [response.Daily() for response in responses]
+    lengths = np.array(
+        [(daily.TimeEnd() - daily.Time()) // daily.Interval() for daily in dailies],
+        dtype="int64",
+    )
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    dates = np.empty(offsets[-1], dtype="int64")
+    columns = {
+        var_name: np.empty(
+            offsets[-1],
+            dtype="int64" if var_name in OPENMETEO_INT64_VARIABLES else "float32",
+        )
+        for var_name in daily_vars
     }
-    responses = openmeteo.weather_api(url, params=params)
-    weather_df = pd.DataFrame()
-
-    daily_vars = params["daily"]
-    for response, place_id in zip(responses, places.keys()):
-        daily = response.Daily()
-        daily_data = {
-            "id": place_id,
-            "date": pd.date_range(
-                start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-                end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-                freq=pd.Timedelta(seconds=daily.Interval()),
-                inclusive="left",
-            ),
-        }
+    for daily, start, end in zip(dailies, offsets[:-1], offsets[1:]):
+        dates[start:end] = daily.Time() + daily.Interval() * np.arange(end - start)
         for i, var_name in enumerate(daily_vars):
-            if var_name in ["sunset", "sunrise"]:
-                daily_data[var_name] = daily.Variables(i).ValuesInt64AsNumpy()
+            if var_name in OPENMETEO_INT64_VARIABLES:
+                columns[var_name][start:end] = daily.Variables(i).ValuesInt64AsNumpy()
             else:
-                daily_data[var_name] = daily.Variables(i).ValuesAsNumpy()
-
-        weather_df = pd.concat([weather_df, pd.DataFrame(data=daily_data)])
+                columns[var_name][start:end] = daily.Variables(i).ValuesAsNumpy()
 
-    weather_df.dropna(inplace=True)
+    weather_df = pd.DataFrame(
+        {
+            "id": np.repeat(np.asarray(place_ids, dtype=object), lengths),
+            "date": pd.to_datetime(dates, unit="s", utc=True),
+            **columns,
+        }
+    )
+    if dropna:
+        weather_df.dropna(inplace=True)
     weather_df["date"] = weather_df["date"].dt.date
     return weather_df
 
 
-def get_historical(aq_df: pd.DataFrame, places: dict[str, dict]) -> pd.DataFrame:
-    """Get historical weather for all places and date ranges in the aq_df"""
-    return get_historical_in_daterange(
-        [
-            aq_df[aq_df["id"] == place["id"]]["date"].min().strftime("%Y-%m-%d")
-            for place in places.values()
-        ],
-        [
-            aq_df[aq_df["id"] == place["id"]]["date"].max().strftime("%Y-%m-%d")
-            for place in places.values()
-        ],
-        places,
+def _locations(places: dict[str, dict], store: WeatherStore) -> pd.DataFrame:
+    """Grid cell coordinates of each place, columns [id, latitude, longitude]
+
+    Places in the same grid cell get the same coordinates, which is what
+    deduplicates requests: missing cells are collected per unique coordinate,
+    and merging the cells back on coordinates fans rows out to every place."""
+    locations = pd.DataFrame(
+        {
+            "id": list(places.keys()),
+            "latitude": [place["latitude"] for place in places.values()],
+            "longitude": [place["longitude"] for place in places.values()],
+        }
+    )
+    locations["latitude"] = store.snap(locations["latitude"])
+    locations["longitude"] = store.snap(locations["longitude"])
+    return locations
+
+
+def _missing(
+    requested: pd.DataFrame, cells: pd.DataFrame, complete: bool = False
+) -> pd.DataFrame:
+    """Requested cells that are not present in `cells`
+
+    With `complete`, cells fetched before one of the daily variables was added
+    to OPENMETEO_DAILY_VARIABLES count as missing, as do cells with missing
+    values that were fetched too soon after their day for them to be final.
+    Cells whose values are still missing after ARCHIVE_DELAY are kept, so
+    they are not fetched again on every run."""
+    if complete:
+        values = cells.reindex(columns=OPENMETEO_DAILY_VARIABLES)
+        day = pd.to_datetime(cells["date"]).dt.tz_localize("UTC")
+        final = (cells["fetched_at"] >= day + ARCHIVE_DELAY) & (
+            cells.reindex(columns=["variables"])["variables"] == VARIABLES_KEY
+        )
+        cells = cells[values.notna().all(axis=1) | final]
+    merged = requested.merge(cells[CELL_KEY], on=CELL_KEY, how="left", indicator=True)
+    return merged[merged["_merge"] == "left_only"].drop(columns="_merge")
+
+
+def _fetch(
+    url: str,
+    locations: pd.DataFrame,
+    params: dict,
+    limiter: RateLimiter | None = None,
+) -> pd.DataFrame:
+    """Fetch weather cells for the locations in a single request
+
+    Cells with missing values are kept, so that they are stored as fetched.
+
+    Arguments:
+        url: Open-Meteo endpoint
+        locations: DataFrame with [latitude, longitude] of each location
+        params: extra request parameters, per location lists allowed
+        limiter: rate limiter to acquire before sending the request
+
+    Returns:
+        pd.DataFrame with columns
+        [latitude, longitude, date, fetched_at, weather_records..., variables]"""
+    retry_session = retry(requests.Session(), retries=5, backoff_factor=0.2)
+    openmeteo = openmeteo_requests.Client(session=retry_session)
+    if limiter is not None:
+        limiter.acquire()
+    responses = openmeteo.weather_api(
+        url,
+        params={
+            "latitude": locations["latitude"].tolist(),
+            "longitude": locations["longitude"].tolist(),
+            "daily": OPENMETEO_DAILY_VARIABLES,
+            **params,
+        },
+    )
+    cells = decode_daily(responses, list(range(len(locations.index))), dropna=False)
+    # The ids are the positions of the locations, decoded as an object column
+    location = cells.pop("id").to_numpy(dtype="int64")
+    cells.insert(0, "latitude", locations["latitude"].to_numpy()[location])
+    cells.insert(1, "longitude", locations["longitude"].to_numpy()[location])
+    cells.insert(3, "fetched_at", pd.Timestamp.now(tz="UTC"))
+    cells["variables"] = VARIABLES_KEY
+    return cells
+
+
+def _merge_cells(requested: pd.DataFrame, cells: pd.DataFrame) -> pd.DataFrame:
+    """Weather of the requested cells, columns [id, date, weather_records...]
+    in the dtypes of `schema.coerce`"""
+    cells = cells.drop_duplicates(CELL_KEY, keep="last")
+    weather_df = requested.merge(cells, on=CELL_KEY, how="inner")
+    weather_df.dropna(subset=OPENMETEO_DAILY_VARIABLES, inplace=True)
+    return schema.coerce(
+        weather_df[["id", "date", *OPENMETEO_DAILY_VARIABLES]].reset_index(drop=True)
+    )
+
+
+def get_forecast(
+    forecast_days: int, places: dict[str, dict], store: WeatherStore | None = None
+) -> pd.DataFrame:
+    """Get the weather forecast for all places, starting today
+
+    Only grid cells without a forecast fetched since the latest issue time are
+    requested, the rest is served from the local weather store. Each grid cell
+    is requested once, however many places it contains."""
+    store = store or WeatherStore()
+    locations = _locations(places, store)
+    now = pd.Timestamp.now(tz="UTC")
+    dates = pd.DataFrame(
+        {"date": pd.date_range(now.normalize(), periods=forecast_days).date}
+    )
+    requested = locations.merge(dates, how="cross")
+
+    cells = store.load("forecast")
+    cells = cells[cells["fetched_at"] >= now.floor(FORECAST_ISSUE_INTERVAL)]
+    stale = _missing(requested, cells)[["latitude", "longitude"]].drop_duplicates()
+    if not stale.empty:
+        fetched = _fetch(FORECAST_URL, stale, {"forecast_days": forecast_days})
+        store.save("forecast", fetched)
+        cells = pd.concat([cells, fetched], ignore_index=True)
+    return _merge_cells(requested, cells)
+
+
+def get_historical(
+    aq_df: pd.DataFrame, places: dict[str, dict], chunked: bool = False
+) -> pd.DataFrame:
+    """Get historical weather for all places and date ranges in the aq_df
+
+    If `chunked` is set, missing weather is fetched in resumable chunks,
+    see `get_historical_chunked`."""
+    bounds = aq_df.groupby("id", observed=True)["date"].agg(["min", "max"])
+    starts = [
+        bounds.loc[place["id"], "min"].strftime("%Y-%m-%d")
+        for place in places.values()
+    ]
+    ends = [
+        bounds.loc[place["id"], "max"].strftime("%Y-%m-%d")
+        for place in places.values()
+    ]
+    if chunked:
+        return get_historical_chunked(starts, ends, places)
+    return get_historical_in_daterange(starts, ends, places)
+
+
+def _requested_daterange(
+    starts: list[str], ends: list[str], locations: pd.DataFrame
+) -> pd.DataFrame:
+    """One row per location and day between its start and end date"""
+    start_days = pd.to_datetime(starts).to_numpy().astype("datetime64[D]")
+    end_days = pd.to_datetime(ends).to_numpy().astype("datetime64[D]")
+    lengths = np.maximum((end_days - start_days).astype("int64") + 1, 0)
+    location = np.repeat(np.arange(len(lengths)), lengths)
+    day_in_range = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    requested = locations.iloc[location].reset_index(drop=True)
+    requested["date"] = pd.to_datetime(start_days[location] + day_in_range).date
+    return requested
+
+
+def _archive_gaps(requested: pd.DataFrame, cells: pd.DataFrame) -> pd.DataFrame:
+    """First and last date of each run of consecutive missing days of each
+    location, columns [latitude, longitude, start_date, end_date]
+
+    Scattered missing days are requested as separate runs rather than as the
+    whole span between the first and last of them."""
+    missing = (
+        _missing(requested, cells, complete=True)[["latitude", "longitude", "date"]]
+        .drop_duplicates()
+        .sort_values(["latitude", "longitude", "date"])
+    )
+    day = pd.to_datetime(missing["date"])
+    new_run = (
+        missing["latitude"].ne(missing["latitude"].shift())
+        | missing["longitude"].ne(missing["longitude"].shift())
+        | day.diff().ne(pd.Timedelta(days=1))
+    )
+    return (
+        missing.groupby(new_run.cumsum().to_numpy(), sort=False)
+        .agg(
+            latitude=("latitude", "first"),
+            longitude=("longitude", "first"),
+            start_date=("date", "min"),
+            end_date=("date", "max"),
+        )
+        .reset_index(drop=True)
     )
 
 
 def get_historical_in_daterange(
-    starts: date, ends: date, places: dict[str, dict]
+    starts: list[str],
+    ends: list[str],
+    places: dict[str, dict],
+    store: WeatherStore | None = None,
 ) -> pd.DataFrame:
     """Get historical weather for all places in the places list
 
-    The aq_df has the air quality readings for each place. Checks for each place
-    what date range it has air quality data for, and requests weather data
-    in that range.
+    Weather is cached per grid cell and day in the local weather store, only
+    the days that are not stored yet are requested from the archive, once per
+    grid cell however many places it contains.
 
     Arguments:
         starts: list of start date for each place (in dict key order)
         ends: list of end date for each place (in dict key order)
         places: dict of place id to place data (latitude, longitude)
+        store: weather store to read and write cells
 
     Returns:
         pd.DataFrame with columns [id, date, weather_records...]
         where id is the place id
         weather_records is all weather data points available from the api"""
-    # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession(".cache", expire_after=-1)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
+    store = store or WeatherStore()
+    requested = _requested_daterange(starts, ends, _locations(places, store))
 
-    # Make sure all required weather variables are listed here
-    # The order of variables in hourly or daily is important to assign them correctly below
-    url = "https://archive-api.open-meteo.com/v1/archive"
-    params = {
-        "latitude": [place["latitude"] for place in places.values()],
-        "longitude": [place["longitude"] for place in places.values()],
-        "start_date": starts,
-        "end_date": ends,
-        "daily": OPENMETEO_DAILY_VARIABLES,
-    }
-    responses = openmeteo.weather_api(url, params=params)
-    weather_df = pd.DataFrame()
-
-    daily_vars = params["daily"]
-    for response, place_id in zip(responses, places.keys()):
-        daily = response.Daily()
-        daily_data = {
-            "id": place_id,
-            "date": pd.date_range(
-                start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-                end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-                freq=pd.Timedelta(seconds=daily.Interval()),
-                inclusive="left",
-            ),
-        }
+    cells = store.load("archive")
+    gaps = _archive_gaps(requested, cells)
+    if not gaps.empty:
+        fetched = _fetch(
+            ARCHIVE_URL,
+            gaps,
+            {
+                "start_date": [day.isoformat() for day in gaps["start_date"]],
+                "end_date": [day.isoformat() for day in gaps["end_date"]],
+            },
+        )
+        store.save("archive", fetched)
+        cells = pd.concat([cells, fetched], ignore_index=True)
+    return _merge_cells(requested, cells)
 
-        for i, var_name in enumerate(daily_vars):
-            if var_name in ["sunset", "sunrise"]:
-                daily_data[var_name] = daily.Variables(i).ValuesInt64AsNumpy()
-            else:
-                daily_data[var_name] = daily.Variables(i).ValuesAsNumpy()
-        weather_df = pd.concat([weather_df, pd.DataFrame(data=daily_data)])
-    weather_df.dropna(inplace=True)
-    weather_df["date"] = weather_df["date"].dt.date
-    return weather_df
+
+def _plan_chunks(
+    starts: list[str],
+    ends: list[str],
+    keys: list,
+    group_size: int,
+    window_days: int,
+) -> list[tuple[list, list[str], list[str]]]:
+    """Split per location date ranges into (keys, starts, ends) chunks
+
+    Locations are grouped `group_size` at a time and each group's date ranges
+    are cut into windows of `window_days`. Locations without dates in a window
+    are left out of that chunk."""
+    starts = [date.fromisoformat(str(start)) for start in starts]
+    ends = [date.fromisoformat(str(end)) for end in ends]
+    chunks = []
+    for group_start in range(0, len(keys), group_size):
+        group = range(group_start, min(group_start + group_size, len(keys)))
+        window_start = min(starts[i] for i in group)
+        last_end = max(ends[i] for i in group)
+        while window_start <= last_end:
+            window_end = window_start + timedelta(days=window_days - 1)
+            chunk = ([], [], [])
+            for i in group:
+                start, end = max(starts[i], window_start), min(ends[i], window_end)
+                if start <= end:
+                    chunk[0].append(keys[i])
+                    chunk[1].append(start.isoformat())
+                    chunk[2].append(end.isoformat())
+            if chunk[0]:
+                chunks.append(chunk)
+            window_start = window_end + timedelta(days=1)
+    return chunks
+
+
+def get_historical_chunked(
+    starts: list[str],
+    ends: list[str],
+    places: dict[str, dict],
+    store: WeatherStore | None = None,
+    group_size: int = 10,
+    window_days: int = 365,
+    max_workers: int = 4,
+    requests_per_second: float = 1.0,
+) -> pd.DataFrame:
+    """Get historical weather like `get_historical_in_daterange`, in chunks
+
+    The days missing from the weather store are split into (location group,
+    date window) chunks that are fetched by a bounded thread pool, with
+    requests rate limited across workers. Every finished chunk is saved to the
+    store right away, so a rerun after a crash only fetches what is missing.
+
+    Arguments:
+        starts: list of start date for each place (in dict key order)
+        ends: list of end date for each place (in dict key order)
+        places: dict of place id to place data (latitude, longitude)
+        store: weather store to read and write cells
+        group_size: maximum number of locations per request
+        window_days: maximum number of days per request
+        max_workers: number of requests in flight at the same time
+        requests_per_second: rate limit shared by all workers
+
+    Returns:
+        pd.DataFrame with columns [id, date, weather_records...]"""
+    store = store or WeatherStore()
+    requested = _requested_daterange(starts, ends, _locations(places, store))
+    gaps = _archive_gaps(requested, store.load("archive"))
+    limiter = RateLimiter(requests_per_second)
+
+    def fetch_chunk(chunk) -> None:
+        rows, chunk_starts, chunk_ends = chunk
+        cells = _fetch(
+            ARCHIVE_URL,
+            gaps.iloc[rows],
+            {"start_date": chunk_starts, "end_date": chunk_ends},
+            limiter=limiter,
+        )
+        store.save("archive", cells)
+
+    chunks = _plan_chunks(
+        gaps["start_date"].tolist(),
+        gaps["end_date"].tolist(),
+        list(range(len(gaps.index))),
+        group_size,
+        window_days,
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_chunk, chunk) for chunk in chunks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            future.result()
+            logger.info("Weather backfill: fetched chunk %d/%d", done, len(chunks))
+
+    store.compact("archive")
+    return get_historical_in_daterange(starts, ends, places, store)
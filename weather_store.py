@@ -0,0 +1,85 @@
+import os
+import uuid
+from pathlib import Path
+
+import pandas as pd
+
+# Columns identifying a weather cell, on top of the weather variables
+CELL_KEY = ["latitude", "longitude", "date"]
+# Default grid resolution in degrees, about the grid of the ERA5-Land reanalysis,
+# unless WEATHER_GRID_RESOLUTION is set. Places up to ~11 km apart share weather
+# at 0.1°, which is coarser than the forecast models Open-Meteo uses in some
+# regions, and 0 keeps exact coordinates
+GRID_RESOLUTION = 0.1
+
+
+class WeatherStore:
+    """Local columnar cache of daily weather cells
+
+    A cell is the weather of a (latitude, longitude, date), with coordinates
+    snapped to the nearest node of a grid of `resolution` degrees. Places
+    snapped to the same node share their weather, so it is only fetched and
+    stored once.
+    Cells are kept per kind ("archive" or "forecast") as append-only Parquet
+    parts, so concurrent writers never touch each other's files. When a cell
+    is written more than once, the most recently fetched version wins.
+    """
+
+    def __init__(self, path: str = ".weather-cache", resolution: float | None = None):
+        self.path = Path(path)
+        # Read here rather than on import, after the scripts load their .env
+        if resolution is None:
+            resolution = float(
+                os.environ.get("WEATHER_GRID_RESOLUTION", GRID_RESOLUTION)
+            )
+        self.resolution = resolution
+
+    def snap(self, coordinates: pd.Series) -> pd.Series:
+        """Round coordinates to the nearest grid node, a multiple of the
+        resolution, or keep them as they are with a resolution of 0"""
+        coordinates = coordinates.astype("float64")
+        if self.resolution:
+            coordinates = (coordinates / self.resolution).round() * self.resolution
+        # Round off float noise, so equal cells compare equal
+        return coordinates.round(6)
+
+    def _parts(self, kind: str) -> list[Path]:
+        return sorted((self.path / kind).glob("*.parquet"))
+
+    def load(self, kind: str) -> pd.DataFrame:
+        """Load all cells of a kind, with columns
+        [latitude, longitude, date, fetched_at, weather_records...]"""
+        parts = self._parts(kind)
+        if not parts:
+            return pd.DataFrame(
+                {
+                    "latitude": pd.Series(dtype="float64"),
+                    "longitude": pd.Series(dtype="float64"),
+                    "date": pd.Series(dtype="object"),
+                    "fetched_at": pd.Series(dtype="datetime64[ns, UTC]"),
+                }
+            )
+        cells = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+        return cells.sort_values("fetched_at", kind="stable").drop_duplicates(
+            CELL_KEY, keep="last"
+        )
+
+    def save(self, kind: str, cells: pd.DataFrame) -> None:
+        """Append cells of a kind, written as a new part"""
+        if cells.empty:
+            return
+        (self.path / kind).mkdir(parents=True, exist_ok=True)
+        part = self.path / kind / f"{uuid.uuid4().hex}.parquet"
+        # Write then rename, so readers never see a partial part
+        tmp_part = part.with_suffix(".tmp")
+        cells.to_parquet(tmp_part, index=False)
+        os.replace(tmp_part, part)
+
+    def compact(self, kind: str) -> None:
+        """Rewrite all parts of a kind as a single part without duplicates"""
+        parts = self._parts(kind)
+        if len(parts) < 2:
+            return
+        self.save(kind, self.load(kind))
+        for part in parts:
+            part.unlink()